@@ -1,97 +1,116 @@
-import json
+import asyncio
+import numpy as np
 from uuid import UUID
-from async_embeddings import generate_embedding_async, save_embedding
-from rag import retrieve_similar
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from async_embeddings import generate_embedding_async, save_embedding_async
+from embeddings import hash_content
+from rag import retrieve_similar_scored_async
 from llm import generate_cleaning_suggestion
-from database import get_session
+from cleaning import parse_suggestion, serialize_row, suggestion_confidence
+from semantic_cache import find_cached_suggestion_async
+from database import AsyncSessionLocal
 from models import CleaningResult
 from typing import Dict, Any, Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
-async def process_row_async(tenant_id: str, dataset_id: UUID, row: Dict[str, Any]) -> Dict[str, Any]:
+async def process_row_async(
+    tenant_id: str,
+    dataset_id: UUID,
+    row: Dict[str, Any],
+    session: Optional[AsyncSession] = None
+) -> Dict[str, Any]:
     """
     Process a data row asynchronously:
     1. Generate embedding for the row (async, CPU-bound)
-    2. Retrieve similar context from tenant embeddings (RAG) - sync for now
-    3. Call LLM asynchronously with context to generate cleaning suggestions
-    4. Store results in database
+    2. Save the embedding concurrently with steps 3-4
+    3. Retrieve similar context from tenant embeddings (RAG)
+    4. Reuse the suggestion of a near-duplicate row, or call the LLM asynchronously with context
+    5. Store results in database
+    
+    All database work runs on `session` (e.g. the request-scoped session from
+    get_async_session); a pooled session is opened when none is given.
     
     Returns: {id, status, suggestion}
     """
+    if session is None:
+        async with AsyncSessionLocal() as session:
+            return await _process_row(session, tenant_id, dataset_id, row)
+    return await _process_row(session, tenant_id, dataset_id, row)
+
+async def _process_row(
+    session: AsyncSession,
+    tenant_id: str,
+    dataset_id: UUID,
+    row: Dict[str, Any]
+) -> Dict[str, Any]:
     try:
         # Step 1: Convert row to text representation
-        text_representation = json.dumps(row, indent=2)
+        text_representation = serialize_row(row)
         logger.info(f"Processing row async for tenant {tenant_id}, dataset {dataset_id}")
         
         # Step 2: Generate embedding for this row (async, prevents blocking)
         embedding = await generate_embedding_async(text_representation)
         logger.debug(f"Generated embedding with dimension: {len(embedding)}")
         
-        # Step 3: Save embedding to database for future RAG queries
-        save_embedding(tenant_id, text_representation, embedding)
-        
-        # Step 4: Retrieve similar context from database (RAG) - sync operation
-        context_docs = retrieve_similar(tenant_id, embedding, top_k=3)
-        context = "\n---\n".join(context_docs) if context_docs else "No previous examples available."
-        logger.info(f"Retrieved {len(context_docs)} similar documents for context")
-        
-        # Step 5: Generate cleaning suggestion from LLM with context (async)
-        suggestion_text = await generate_cleaning_suggestion(context, text_representation)
-        logger.debug(f"LLM response received")
-        
-        # Step 6: Parse suggestion JSON
-        suggestion_json = _parse_suggestion(suggestion_text)
-        
-        # Step 7: Save cleaning result to database
-        session = get_session()
+        # Step 3: Save embedding for future RAG queries in the background; nothing
+        # below depends on it, so it overlaps with the RAG read and the LLM call
+        save_task = asyncio.create_task(
+            _save_embedding_detached(tenant_id, text_representation, embedding)
+        )
         try:
-            cleaning_record = CleaningResult(
+            # Step 4: Retrieve similar context from database (RAG)
+            scored_docs = await retrieve_similar_scored_async(session, tenant_id, embedding, top_k=3)
+            context_docs = [content for content, _ in scored_docs]
+            context = "\n---\n".join(context_docs) if context_docs else "No previous examples available."
+            logger.info(f"Retrieved {len(context_docs)} similar documents for context")
+            
+            # Step 5: Reuse the suggestion of a near-duplicate row (semantic cache)
+            suggestion_json = await find_cached_suggestion_async(session, tenant_id, scored_docs)
+            
+            # Release the connection back to the pool while waiting on the LLM
+            await session.commit()
+            
+            if suggestion_json is None:
+                # Step 6: Generate cleaning suggestion from LLM with context (async) and parse it
+                suggestion_text = await generate_cleaning_suggestion(context, text_representation)
+                logger.debug(f"LLM response received")
+                suggestion_json = parse_suggestion(suggestion_text)
+        finally:
+            await save_task
+        
+        # Step 7: Save cleaning result to database (single Core INSERT ... RETURNING)
+        table = CleaningResult.__table__
+        result_id, status = (await session.execute(
+            insert(table)
+            .values(
                 tenant_id=tenant_id,
                 dataset_id=dataset_id,
                 row_data=row,
                 ai_suggestion=suggestion_json,
-                confidence=suggestion_json.get("confidence", None),
-                status="processed"
+                confidence=suggestion_confidence(suggestion_json),
+                status="processed",
+                content_hash=hash_content(text_representation)
             )
-            session.add(cleaning_record)
-            session.commit()
-            session.refresh(cleaning_record)
-            
-            logger.info(f"Cleaning result saved with ID: {cleaning_record.id}")
-            return {
-                "id": cleaning_record.id,
-                "status": cleaning_record.status,
-                "suggestion": suggestion_json
-            }
-        finally:
-            session.close()
+            .returning(table.c.id, table.c.status)
+        )).one()
+        await session.commit()
+        
+        logger.info(f"Cleaning result saved with ID: {result_id}")
+        return {
+            "id": result_id,
+            "status": status,
+            "suggestion": suggestion_json
+        }
     
     except Exception as e:
         logger.error(f"Error processing row: {str(e)}", exc_info=True)
+        await session.rollback()
         raise
 
-def _parse_suggestion(suggestion_text: str) -> Dict[str, Any]:
-    """Parse LLM suggestion text into JSON"""
-    try:
-        # Try direct JSON parsing
-        return json.loads(suggestion_text)
-    except json.JSONDecodeError:
-        # If not valid JSON, extract JSON from response
-        try:
-            start = suggestion_text.find('{')
-            end = suggestion_text.rfind('}') + 1
-            if start >= 0 and end > start:
-                json_str = suggestion_text[start:end]
-                return json.loads(json_str)
-        except Exception:
-            pass
-        
-        # Return raw suggestion if JSON parsing fails
-        logger.warning("Could not parse suggestion as JSON, returning as raw text")
-        return {
-            "status": "error",
-            "message": "Could not parse LLM response",
-            "raw_response": suggestion_text
-        }
+async def _save_embedding_detached(tenant_id: str, content: str, embedding: np.ndarray) -> int:
+    """Save an embedding on its own pooled session so it can run concurrently with the request session"""
+    async with AsyncSessionLocal() as session:
+        return await save_embedding_async(session, tenant_id, content, embedding)
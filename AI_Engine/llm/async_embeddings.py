@@ -1,79 +1,109 @@
-from sentence_transformers import SentenceTransformer
 import numpy as np
 import asyncio
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from concurrent.futures import ThreadPoolExecutor
-from config import HF_EMBEDDING_MODEL
+from embeddings import generate_embedding as _cached_generate_embedding, generate_embeddings, save_embedding, to_db_vector
+from rag import add_to_tenant_cache
 from models import TenantEmbedding
-from typing import List
+from config import EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_WAIT_MS
+from typing import Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Load embedding model once (lightweight, ~80MB)
-model = SentenceTransformer(HF_EMBEDDING_MODEL)
-
 # Thread pool for CPU-bound embedding operations
 _executor = ThreadPoolExecutor(max_workers=2)
 
-def _generate_embedding_sync(text: str) -> List[float]:
-    """Synchronous embedding generation (CPU-bound)"""
-    try:
-        embedding = model.encode(text)
-        return embedding.tolist() if hasattr(embedding, 'tolist') else list(embedding)
-    except Exception as e:
-        logger.error(f"Error generating embedding: {e}", exc_info=True)
-        raise
+class EmbeddingBatcher:
+    """
+    Dynamic batching for async embedding requests.
+    
+    Texts submitted by concurrent requests within max_wait_ms of each other are
+    encoded with one generate_embeddings call, so N concurrent rows cost one
+    batched forward pass instead of N serialized ones.
+    """
+    
+    def __init__(self, max_batch_size: int, max_wait_ms: float):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+    
+    async def embed(self, text: str) -> np.ndarray:
+        """Queue a text for the next batch and wait for its embedding"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = await loop.run_in_executor(_executor, generate_embeddings, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
 
-async def generate_embedding_async(text: str) -> List[float]:
+_batcher = EmbeddingBatcher(max_batch_size=EMBEDDING_BATCH_SIZE, max_wait_ms=EMBEDDING_BATCH_WAIT_MS)
+
+def _generate_embedding_sync(text: str) -> np.ndarray:
+    """Synchronous embedding generation (CPU-bound, shares the model and cache in embeddings.py)"""
+    return _cached_generate_embedding(text)
+
+async def generate_embedding_async(text: str) -> np.ndarray:
     """
-    Async embedding generation using thread pool
-    This prevents blocking the event loop during CPU-intensive operations
+    Async embedding generation, micro-batched with other concurrent requests.
+    Encoding runs in a thread pool so it doesn't block the event loop.
     """
     try:
-        loop = asyncio.get_event_loop()
-        embedding = await loop.run_in_executor(_executor, _generate_embedding_sync, text)
-        return embedding
+        return await _batcher.embed(text)
     except Exception as e:
         logger.error(f"Error generating async embedding: {e}", exc_info=True)
         raise
 
-# Keep sync version for backward compatibility
-def generate_embedding(text: str) -> List[float]:
+# Keep sync versions for backward compatibility (save_embedding is re-exported from embeddings)
+def generate_embedding(text: str) -> np.ndarray:
     """Synchronous embedding generation (deprecated, use async version)"""
     return _generate_embedding_sync(text)
 
-async def save_embedding_async(tenant_id: str, content: str, embedding: List[float]) -> TenantEmbedding:
-    """Save embedding to database (async placeholder)"""
-    # For now, we'll keep this synchronous since sqlalchemy-utils doesn't have async support
-    # In production, you'd use SQLAlchemy async session
-    from database import get_session
-    session = get_session()
-    try:
-        embedding_record = TenantEmbedding(
-            tenant_id=tenant_id,
-            content=content,
-            embedding=embedding
-        )
-        session.add(embedding_record)
-        session.commit()
-        session.refresh(embedding_record)
-        return embedding_record
-    finally:
-        session.close()
-
-def save_embedding(tenant_id: str, content: str, embedding: List[float]) -> TenantEmbedding:
-    """Synchronous embedding save (backward compatible)"""
-    from database import get_session
-    session = get_session()
-    try:
-        embedding_record = TenantEmbedding(
-            tenant_id=tenant_id,
-            content=content,
-            embedding=embedding
-        )
-        session.add(embedding_record)
-        session.commit()
-        session.refresh(embedding_record)
-        return embedding_record
-    finally:
-        session.close()
+async def save_embedding_async(
+    session: AsyncSession,
+    tenant_id: str,
+    content: str,
+    embedding: np.ndarray
+) -> int:
+    """Save embedding to database in one INSERT ... RETURNING round-trip, returns its ID"""
+    # Core table insert: executes as plain SQL on the session's connection, skipping ORM insert handling
+    table = TenantEmbedding.__table__
+    embedding_id = (await session.execute(
+        insert(table)
+        .values(tenant_id=tenant_id, content=content, embedding=to_db_vector(embedding))
+        .returning(table.c.id)
+    )).scalar_one()
+    await session.commit()
+    # Per-tenant locks may be held by a concurrent index build, so keep them off the event loop
+    await asyncio.to_thread(add_to_tenant_cache, tenant_id, [embedding_id], [content], [embedding])
+    return embedding_id
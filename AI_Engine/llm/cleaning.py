@@ -1,28 +1,65 @@
+import asyncio
 import json
+import math
+import orjson
+import numpy as np
 from uuid import UUID
-from embeddings import generate_embedding, save_embedding
-from rag import retrieve_similar
-from llm import generate_cleaning_suggestion
-from database import get_session
+from sqlalchemy import insert
+from embeddings import generate_embedding, generate_embeddings, hash_content, save_embedding, save_embeddings
+from rag import retrieve_similar_scored
+from llm import find_json_object, generate_cleaning_suggestion, generate_cleaning_suggestions_batch
+from semantic_cache import find_cached_suggestion
+from database import engine
 from models import CleaningResult
-from typing import Dict, Any, Optional
+from concurrency import ConcurrencyManager
+from config import ROW_MAX_CONCURRENCY
+from typing import Awaitable, Callable, Dict, Any, List, Optional, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
 
+def serialize_row(row: Dict[str, Any]) -> str:
+    """
+    Canonical compact JSON for a row.
+    
+    Computed once per row and reused for the embedding, its cache key, the
+    stored RAG content and the LLM prompt. Sorted keys keep cache keys stable
+    across key order; orjson's compact output keeps prompts small.
+    
+    Uploaded data orjson can't represent faithfully (integers wider than 64
+    bits, NaN/Infinity, which it would write as null) goes through the stdlib
+    json module with the same canonical options instead.
+    """
+    if not _has_non_finite(row):
+        try:
+            return orjson.dumps(row, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS).decode()
+        except (orjson.JSONEncodeError, TypeError):
+            pass
+    return json.dumps(row, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+def _has_non_finite(value: Any) -> bool:
+    """Whether a JSON-like value contains NaN or Infinity"""
+    if isinstance(value, float):
+        return not math.isfinite(value)
+    if isinstance(value, dict):
+        return any(_has_non_finite(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(_has_non_finite(item) for item in value)
+    return False
+
 async def process_row(tenant_id: str, dataset_id: UUID, row: Dict[str, Any]) -> Dict[str, Any]:
     """
     Process a data row:
     1. Generate embedding for the row
     2. Retrieve similar context from tenant embeddings (RAG)
-    3. Call LLM with context to generate cleaning suggestions
+    3. Reuse the suggestion of a near-duplicate row, or call the LLM with context
     4. Store results in database
     
     Returns: {id, status, suggestion}
     """
     try:
         # Step 1: Convert row to text representation
-        text_representation = json.dumps(row, indent=2)
+        text_representation = serialize_row(row)
         logger.info(f"Processing row for tenant {tenant_id}, dataset {dataset_id}")
         
         # Step 2: Generate embedding for this row
@@ -33,61 +70,207 @@ async def process_row(tenant_id: str, dataset_id: UUID, row: Dict[str, Any]) ->
         save_embedding(tenant_id, text_representation, embedding)
         
         # Step 4: Retrieve similar context from database (RAG)
-        context_docs = retrieve_similar(tenant_id, embedding, top_k=3)
+        scored_docs = retrieve_similar_scored(tenant_id, embedding, top_k=3)
+        context_docs = [content for content, _ in scored_docs]
         context = "\n---\n".join(context_docs) if context_docs else "No previous examples available."
         logger.info(f"Retrieved {len(context_docs)} similar documents for context")
         
-        # Step 5: Generate cleaning suggestion from LLM with context
-        suggestion_text = generate_cleaning_suggestion(context, text_representation)
-        logger.debug(f"LLM response received")
+        # Step 5: Reuse the suggestion of a near-duplicate row (semantic cache)
+        suggestion_json = find_cached_suggestion(tenant_id, scored_docs)
+        if suggestion_json is None:
+            # Step 6: Generate cleaning suggestion from LLM with context and parse it
+            suggestion_text = await generate_cleaning_suggestion(context, text_representation)
+            logger.debug(f"LLM response received")
+            suggestion_json = parse_suggestion(suggestion_text)
         
-        # Step 6: Parse suggestion JSON
-        suggestion_json = _parse_suggestion(suggestion_text)
+        # Step 7: Save cleaning result to database (single Core INSERT ... RETURNING)
+        table = CleaningResult.__table__
+        with engine.begin() as conn:
+            result_id, status = conn.execute(
+                insert(table)
+                .values(
+                    tenant_id=tenant_id,
+                    dataset_id=dataset_id,
+                    row_data=row,
+                    ai_suggestion=suggestion_json,
+                    confidence=suggestion_confidence(suggestion_json),
+                    status="processed",
+                    content_hash=hash_content(text_representation)
+                )
+                .returning(table.c.id, table.c.status)
+            ).one()
         
-        # Step 7: Save cleaning result to database
-        session = get_session()
-        try:
-            cleaning_record = CleaningResult(
-                tenant_id=tenant_id,
-                dataset_id=dataset_id,
-                row_data=row,
-                ai_suggestion=suggestion_json,
-                confidence=suggestion_json.get("confidence", None),
-                status="processed"
-            )
-            session.add(cleaning_record)
-            session.commit()
-            session.refresh(cleaning_record)
-            
-            logger.info(f"Cleaning result saved with ID: {cleaning_record.id}")
-            return {
-                "id": cleaning_record.id,
-                "status": cleaning_record.status,
-                "suggestion": suggestion_json
-            }
-        finally:
-            session.close()
+        logger.info(f"Cleaning result saved with ID: {result_id}")
+        return {
+            "id": result_id,
+            "status": status,
+            "suggestion": suggestion_json
+        }
     
     except Exception as e:
         logger.error(f"Error processing row: {str(e)}", exc_info=True)
         raise
 
-def _parse_suggestion(suggestion_text: str) -> Dict[str, Any]:
-    """Parse LLM suggestion text into JSON"""
+async def process_rows_batch(tenant_id: str, dataset_id: UUID, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Process many data rows as one batch:
+    1. Generate embeddings for all rows in a single batched model call
+    2. Save all embeddings in one transaction
+    3. Retrieve similar context for every row concurrently (RAG)
+    4. Reuse suggestions of near-duplicate rows, call the LLM concurrently for the rest
+    5. Store all results with one bulk insert
+    
+    Returns: [{id, status, suggestion}, ...] in row order
+    """
+    return await _process_rows(tenant_id, dataset_id, rows, _suggest_concurrently)
+
+async def process_dataset(
+    tenant_id: str,
+    dataset_id: UUID,
+    rows: List[Dict[str, Any]],
+    on_submitted: Optional[Callable[[str], None]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Process a whole dataset offline through the Gemini batch API.
+    
+    Same steps as process_rows_batch, but all cache misses go to Gemini as one
+    batch job (half the cost of per-row calls, no rate limiting) and the call
+    returns once the job has finished, which can take minutes to hours.
+    
+    Args:
+        on_submitted: Optional callback receiving the Gemini batch name once submitted
+    
+    Returns: [{id, status, suggestion}, ...] in row order
+    """
+    async def suggest_with_batch_job(contexts: List[str], texts: List[str]) -> List[str]:
+        return await generate_cleaning_suggestions_batch(
+            contexts, texts, f"clean_stream-{dataset_id}", on_submitted
+        )
+    
+    return await _process_rows(tenant_id, dataset_id, rows, suggest_with_batch_job)
+
+async def _suggest_concurrently(contexts: List[str], texts: List[str]) -> List[str]:
+    """One LLM call per row (Gemini concurrency is bounded by the global semaphore)"""
+    return await asyncio.gather(*[
+        generate_cleaning_suggestion(context, text)
+        for context, text in zip(contexts, texts)
+    ])
+
+async def _process_rows(
+    tenant_id: str,
+    dataset_id: UUID,
+    rows: List[Dict[str, Any]],
+    suggest: Callable[[List[str], List[str]], Awaitable[List[str]]]
+) -> List[Dict[str, Any]]:
+    """Shared bulk pipeline; `suggest` maps (contexts, row texts) of cache misses to LLM replies"""
+    if not rows:
+        return []
+    
     try:
-        # Try direct JSON parsing
-        return json.loads(suggestion_text)
-    except json.JSONDecodeError:
-        # If not valid JSON, extract JSON from response
-        try:
-            start = suggestion_text.find('{')
-            end = suggestion_text.rfind('}') + 1
-            if start >= 0 and end > start:
-                json_str = suggestion_text[start:end]
-                return json.loads(json_str)
-        except Exception:
-            pass
+        logger.info(f"Processing batch of {len(rows)} rows for tenant {tenant_id}, dataset {dataset_id}")
+        
+        # Step 1: Convert rows to text and embed them together
+        texts = [serialize_row(row) for row in rows]
+        embeddings = await asyncio.to_thread(generate_embeddings, texts)
+        
+        # Step 2: Save embeddings for future RAG queries
+        await asyncio.to_thread(save_embeddings, tenant_id, texts, embeddings)
+        
+        # Step 3: Retrieve similar context and semantic cache hits for every row
+        manager = ConcurrencyManager(max_concurrent=ROW_MAX_CONCURRENCY)
+        lookups = await manager.run_batch([
+            asyncio.to_thread(_lookup_row, tenant_id, embedding)
+            for embedding in embeddings
+        ])
+        lookups = [(None, []) if isinstance(lookup, Exception) else lookup for lookup in lookups]
         
-        # Return raw suggestion if JSON parsing fails
-        logger.warning("Could not parse suggestion as JSON, returning as raw text")
-        return {"status": "error", "message": "Could not parse LLM response", "raw_response": suggestion_text}
+        # Step 4: Generate suggestions for cache misses
+        misses = [i for i, (cached, _) in enumerate(lookups) if cached is None]
+        suggestion_texts = await suggest(
+            [_format_context(lookups[i][1]) for i in misses],
+            [texts[i] for i in misses]
+        )
+        suggestions = [cached for cached, _ in lookups]
+        for i, suggestion_text in zip(misses, suggestion_texts):
+            suggestions[i] = parse_suggestion(suggestion_text)
+        logger.info(f"Semantic cache served {len(rows) - len(misses)} of {len(rows)} rows")
+        
+        # Step 5: Bulk insert cleaning results in one transaction (Core executemany
+        # INSERT ... RETURNING, sent as multi-row INSERTs via insertmanyvalues)
+        table = CleaningResult.__table__
+        with engine.begin() as conn:
+            saved = conn.execute(
+                insert(table).returning(table.c.id, table.c.status, sort_by_parameter_order=True),
+                [
+                    {
+                        "tenant_id": tenant_id,
+                        "dataset_id": dataset_id,
+                        "row_data": row,
+                        "ai_suggestion": suggestion,
+                        "confidence": suggestion_confidence(suggestion),
+                        "status": "processed",
+                        "content_hash": hash_content(text)
+                    }
+                    for row, text, suggestion in zip(rows, texts, suggestions)
+                ]
+            ).all()
+        
+        logger.info(f"Saved {len(saved)} cleaning results for dataset {dataset_id}")
+        return [
+            {
+                "id": result_id,
+                "status": status,
+                "suggestion": suggestion
+            }
+            for (result_id, status), suggestion in zip(saved, suggestions)
+        ]
+    
+    except Exception as e:
+        logger.error(f"Error processing row batch: {str(e)}", exc_info=True)
+        raise
+
+def _lookup_row(tenant_id: str, embedding: np.ndarray) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+    """RAG context of one row plus the suggestion of a near-duplicate row, if any"""
+    scored_docs = retrieve_similar_scored(tenant_id, embedding, top_k=3)
+    return find_cached_suggestion(tenant_id, scored_docs), [content for content, _ in scored_docs]
+
+def _format_context(context_docs: List[str]) -> str:
+    """Join RAG documents into the prompt context"""
+    return "\n---\n".join(context_docs) if context_docs else "No previous examples available."
+
+def parse_suggestion(suggestion_text: str) -> Dict[str, Any]:
+    """Parse LLM suggestion text into a JSON object"""
+    try:
+        # Try direct JSON parsing
+        parsed = orjson.loads(suggestion_text)
+    except orjson.JSONDecodeError:
+        parsed = None
+    
+    if not isinstance(parsed, dict):
+        # Not a JSON object (prose around it, or an array/scalar): extract the first
+        # balanced object (single pass, nesting-aware)
+        json_str = find_json_object(suggestion_text)
+        if json_str is not None:
+            try:
+                parsed = orjson.loads(json_str)
+            except orjson.JSONDecodeError:
+                pass
+    
+    if isinstance(parsed, dict):
+        return parsed
+    
+    # Return raw suggestion if JSON parsing fails
+    logger.warning("Could not parse suggestion as JSON object, returning as raw text")
+    return {"status": "error", "message": "Could not parse LLM response", "raw_response": suggestion_text}
+
+def suggestion_confidence(suggestion: Dict[str, Any]) -> Optional[float]:
+    """The suggestion's confidence as a float, or None if it is missing or not a finite number"""
+    confidence = suggestion.get("confidence")
+    if confidence is None or isinstance(confidence, bool):
+        return None
+    try:
+        confidence = float(confidence)
+    except (TypeError, ValueError):
+        # e.g. "high"
+        return None
+    return confidence if math.isfinite(confidence) else None
@@ -1,11 +1,12 @@
 import asyncio
 import logging
+from config import GEMINI_MAX_CONCURRENCY
 
 logger = logging.getLogger(__name__)
 
 # Global semaphore to limit concurrent Gemini API calls
 # This prevents rate limiting and resource exhaustion
-gemini_semaphore = asyncio.Semaphore(5)  # Max 5 concurrent Gemini calls
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
 
 async def acquire_semaphore():
     """Acquire semaphore slot for Gemini API call"""
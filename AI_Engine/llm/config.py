@@ -18,13 +18,58 @@ DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "")
 
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+ASYNC_DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "40"))
 
 # Google Gemini Configuration
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", None)
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "5"))  # Keep under the QPM quota
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "60"))
+GEMINI_MAX_OUTPUT_TOKENS = int(os.getenv("GEMINI_MAX_OUTPUT_TOKENS", "512"))  # A suggestion is a small JSON object
+GEMINI_BATCH_POLL_SECONDS = float(os.getenv("GEMINI_BATCH_POLL_SECONDS", "30"))  # Batch jobs take minutes to hours
+# Inline batch submissions are capped at 20 MB; larger datasets are split into several jobs
+GEMINI_BATCH_MAX_BYTES = int(os.getenv("GEMINI_BATCH_MAX_BYTES", str(18 * 1024 * 1024)))
+
+# Row Processing Configuration
+ROW_MAX_CONCURRENCY = int(os.getenv("ROW_MAX_CONCURRENCY", "20"))  # Rows in flight per bulk request
 
 # Embedding Configuration
 HF_EMBEDDING_MODEL = os.getenv("HF_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "384"))  # all-MiniLM-L6-v2 output size
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))  # In-process LRU entries
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# "onnx" runs an int8-quantized ONNX export of the model; "torch" runs sentence-transformers as-is
+EMBEDDING_RUNTIME = os.getenv("EMBEDDING_RUNTIME", "onnx").lower()
+# Split the cores between uvicorn/gunicorn workers instead of every worker using all of them
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+EMBEDDING_NUM_THREADS = int(os.getenv("EMBEDDING_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))))
+# Concurrent async embedding requests arriving within this window are encoded as one batch
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5"))
+ONNX_CACHE_DIR = os.getenv("ONNX_CACHE_DIR", str(Path.home() / ".cache" / "clean_stream" / "onnx"))
+
+# Vector Search Configuration
+# "pgvector" searches inside PostgreSQL (HNSW index); "numpy" (exact) and "usearch"
+# (in-process HNSW) store plain arrays and search in-process for databases where the
+# pgvector extension is unavailable
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pgvector").lower()
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))
+# The tenant filter is applied after the HNSW scan, so a small tenant could get fewer
+# than top_k rows (or none). pgvector 0.8+ iterative scans keep scanning until enough
+# rows pass the filter; set "off" on older pgvector, which rejects the setting
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "strict_order").lower()
+# In-process backends diff the IDs of this many rows below the highest one seen against
+# their cache, so rows whose transactions commit out of ID order (e.g. from other
+# workers) are still picked up
+VECTOR_REFRESH_LOOKBACK = int(os.getenv("VECTOR_REFRESH_LOOKBACK", "1000"))
+# Per-tenant USearch indexes are snapshotted here so restarts don't rebuild them from the database
+USEARCH_INDEX_DIR = os.getenv("USEARCH_INDEX_DIR", str(Path.home() / ".cache" / "clean_stream" / "usearch"))
+
+# Semantic LLM Cache Configuration
+# A row with a tenant embedding (among its RAG neighbours) at least this similar reuses that row's stored
+# suggestion instead of calling Gemini; set above 1 to disable
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
 
 # Validate GEMINI_API_KEY is set
 if not GEMINI_API_KEY:
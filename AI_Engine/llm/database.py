@@ -1,18 +1,127 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, Session
-from config import DATABASE_URL
-from models import Base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from config import ASYNC_DATABASE_URL, DATABASE_URL, DB_MAX_OVERFLOW, DB_POOL_SIZE, EMBEDDING_DIM, VECTOR_BACKEND
+from models import Base, CleaningResult, TenantEmbedding
+from typing import Any, AsyncIterator
+import json
+import orjson
+
+def _json_serializer(value: Any) -> str:
+    """
+    orjson for JSONB columns (faster than the stdlib json SQLAlchemy uses by default),
+    falling back to the stdlib for values it rejects (e.g. integers wider than 64 bits)
+    """
+    try:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+    except (orjson.JSONEncodeError, TypeError):
+        return json.dumps(value)
 
 # Create database engine
-engine = create_engine(DATABASE_URL, echo=False)
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    json_serializer=_json_serializer,
+    json_deserializer=orjson.loads
+)
 
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine (asyncpg) with a shared connection pool for the request path
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    echo=False,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    json_serializer=_json_serializer,
+    json_deserializer=orjson.loads
+)
+
+# No pgvector asyncpg codec is registered: the HALFVEC column type already binds
+# '[...]' text literals, which asyncpg sends as text for halfvec (a binary codec
+# would reject them)
+
+# Async session factory
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 def init_db():
-    """Initialize database tables"""
+    """Initialize database tables (pgvector extension must exist before the vector columns)"""
+    if VECTOR_BACKEND == "pgvector":
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
     Base.metadata.create_all(bind=engine)
+    
+    with engine.begin() as conn:
+        _migrate_json_columns(conn)
+        _migrate_embedding_column(conn)
+        conn.execute(text("ALTER TABLE cleaning_results ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)"))
+    
+    # create_all skips indexes on tables that already exist
+    for index in (*TenantEmbedding.__table__.indexes, *CleaningResult.__table__.indexes):
+        index.create(bind=engine, checkfirst=True)
+
+def _migrate_json_columns(conn):
+    """Convert cleaning_results columns created as text json to jsonb (one-time table rewrite)"""
+    for column in ("row_data", "ai_suggestion"):
+        data_type = conn.execute(
+            text(
+                "SELECT data_type FROM information_schema.columns "
+                "WHERE table_name = 'cleaning_results' AND column_name = :column"
+            ),
+            {"column": column}
+        ).scalar()
+        if data_type == "json":
+            conn.execute(text(
+                f"ALTER TABLE cleaning_results ALTER COLUMN {column} TYPE jsonb USING {column}::jsonb"
+            ))
+
+def _migrate_embedding_column(conn):
+    """
+    Convert tenant_embeddings.embedding from an older layout (double precision[] or
+    vector) to the configured one (one-time table rewrite; runs before the HNSW index
+    is created, which needs halfvec). Older rows were stored unnormalized, so they
+    are L2-normalized on the way, as inner-product ranking requires.
+    """
+    data_type, udt_name = conn.execute(
+        text(
+            "SELECT data_type, udt_name FROM information_schema.columns "
+            "WHERE table_name = 'tenant_embeddings' AND column_name = 'embedding'"
+        )
+    ).one()
+    if VECTOR_BACKEND == "pgvector":
+        if udt_name == "halfvec":
+            return
+        # Arrays go through real[], which pgvector can cast to vector; normalizing
+        # before the halfvec cast keeps the full precision for the division
+        source = "embedding::real[]" if data_type == "ARRAY" else "embedding"
+        conn.execute(text(
+            f"ALTER TABLE tenant_embeddings ALTER COLUMN embedding "
+            f"TYPE halfvec({int(EMBEDDING_DIM)}) USING l2_normalize({source}::vector)::halfvec({int(EMBEDDING_DIM)})"
+        ))
+    elif udt_name != "_float4":
+        # Arrays and pgvector types both cast to real[]
+        conn.execute(text(
+            "ALTER TABLE tenant_embeddings ALTER COLUMN embedding TYPE real[] USING embedding::real[]"
+        ))
+        # ALTER ... USING can't run subqueries, so normalize in a second pass
+        # (zero vectors and rows that are already unit length are left alone)
+        conn.execute(text(
+            "WITH norms AS ("
+            " SELECT id, sqrt(sum(x::float8 * x)) AS norm"
+            " FROM tenant_embeddings, unnest(embedding) AS x GROUP BY id"
+            ") "
+            "UPDATE tenant_embeddings t SET embedding = ARRAY("
+            " SELECT x / n.norm FROM unnest(t.embedding) WITH ORDINALITY AS u(x, i) ORDER BY i"
+            ")::real[] "
+            "FROM norms n WHERE t.id = n.id AND n.norm > 0 AND abs(n.norm - 1) > 1e-3"
+        ))
 
 def get_session() -> Session:
     """Get a database session"""
     return SessionLocal()
+
+async def get_async_session() -> AsyncIterator[AsyncSession]:
+    """FastAPI dependency: one pooled async session per request"""
+    async with AsyncSessionLocal() as session:
+        yield session
@@ -1,10 +1,11 @@
 import asyncio
-import json
 import logging
-from typing import Dict, Any, List
-from uuid import UUID
+import time
+from typing import Dict, Any, List, Optional
+from uuid import UUID, uuid4
 import httpx
 from async_cleaning import process_row_async
+from cleaning import process_dataset as process_dataset_batch
 from config import DATABASE_URL
 
 logger = logging.getLogger(__name__)
@@ -12,9 +13,13 @@ logger = logging.getLogger(__name__)
 class DatasetProcessingService:
     """Service to process entire datasets asynchronously with streaming results"""
     
+    # Finished batch jobs stay queryable via get_job for this long
+    FINISHED_JOB_TTL_SECONDS = 24 * 3600
+    
     def __init__(self, spring_boot_base_url: str = "http://localhost:8080"):
         self.spring_boot_base_url = spring_boot_base_url
         self.active_tasks: Dict[UUID, asyncio.Task] = {}
+        self.jobs: Dict[str, Dict[str, Any]] = {}
     
     async def process_dataset(
         self,
@@ -191,6 +196,84 @@ class DatasetProcessingService:
         except Exception as e:
             logger.error(f"Failed to stream error to Spring Boot: {str(e)}")
     
+    def submit_batch_job(
+        self,
+        tenant_id: str,
+        dataset_id: UUID,
+        rows: List[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        """
+        Start processing a dataset through the Gemini batch API in the background
+        
+        Returns:
+            The job record; poll it with get_job(job_id)
+        """
+        job_id = uuid4().hex
+        job = {
+            "job_id": job_id,
+            "tenant_id": tenant_id,
+            "dataset_id": str(dataset_id),
+            "status": "queued",
+            "total_rows": len(rows),
+            "processed_rows": 0,
+            "batch_names": [],
+            "error": None,
+            "finished_at": None,
+        }
+        self._prune_jobs()
+        self.jobs[job_id] = job
+        
+        logger.info(f"Queued batch job {job_id} - tenant: {tenant_id}, dataset: {dataset_id}, rows: {len(rows)}")
+        task = asyncio.create_task(self._run_batch_job(job, tenant_id, dataset_id, rows))
+        
+        # Tracked like streaming runs, so is_processing/cancel_processing cover batch jobs too
+        self.active_tasks[dataset_id] = task
+        task.add_done_callback(lambda t: self.active_tasks.pop(dataset_id, None))
+        return self.get_job(job_id)
+    
+    async def _run_batch_job(
+        self,
+        job: Dict[str, Any],
+        tenant_id: str,
+        dataset_id: UUID,
+        rows: List[Dict[str, Any]]
+    ):
+        """Background task running one batch job and recording its outcome"""
+        job["status"] = "running"
+        try:
+            results = await process_dataset_batch(
+                tenant_id,
+                dataset_id,
+                rows,
+                on_submitted=job["batch_names"].append
+            )
+            job["processed_rows"] = len(results)
+            job["status"] = "completed"
+            logger.info(f"Batch job {job['job_id']} completed with {len(results)} rows")
+        except asyncio.CancelledError:
+            job["status"] = "cancelled"
+            raise
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+            logger.error(f"Batch job {job['job_id']} failed: {str(e)}", exc_info=True)
+        finally:
+            job["finished_at"] = time.time()
+    
+    def _prune_jobs(self):
+        """Forget batch jobs that finished more than FINISHED_JOB_TTL_SECONDS ago"""
+        cutoff = time.time() - self.FINISHED_JOB_TTL_SECONDS
+        for job_id in [
+            job_id for job_id, job in self.jobs.items()
+            if job["finished_at"] is not None and job["finished_at"] < cutoff
+        ]:
+            del self.jobs[job_id]
+    
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Status of a batch job, or None if unknown"""
+        job = self.jobs.get(job_id)
+        return {**job, "batch_names": list(job["batch_names"])} if job else None
+    
     def is_processing(self, dataset_id: UUID) -> bool:
         """Check if dataset is currently processing"""
         return dataset_id in self.active_tasks
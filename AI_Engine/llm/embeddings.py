@@ -1,37 +1,209 @@
-from sentence_transformers import SentenceTransformer
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import threading
 import numpy as np
-from config import HF_EMBEDDING_MODEL
-from database import get_session
-from models import TenantEmbedding
-from typing import List
+from config import (
+    HF_EMBEDDING_MODEL, EMBEDDING_CACHE_SIZE, EMBEDDING_BATCH_SIZE, EMBEDDING_NUM_THREADS,
+    EMBEDDING_RUNTIME, ONNX_CACHE_DIR, VECTOR_BACKEND
+)
+from database import engine, get_session
+from rag import add_to_tenant_cache
+from models import TenantEmbedding, EmbeddingCache
+from typing import Any, Dict, List
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Load embedding model once (lightweight, ~80MB)
-model = SentenceTransformer(HF_EMBEDDING_MODEL)
+# Quantized vectors differ slightly, so they get their own embedding_cache entries
+EMBEDDING_CACHE_MODEL = f"{HF_EMBEDDING_MODEL}#onnx-int8" if EMBEDDING_RUNTIME == "onnx" else HF_EMBEDDING_MODEL
 
-def generate_embedding(text: str) -> List[float]:
-    """Generate embedding vector for given text using sentence-transformers"""
-    try:
-        embedding = model.encode(text)
-        return embedding.tolist() if hasattr(embedding, 'tolist') else list(embedding)
-    except Exception as e:
-        logger.error(f"Error generating embedding: {e}", exc_info=True)
-        raise
-
-def save_embedding(tenant_id: str, content: str, embedding: List[float]) -> TenantEmbedding:
-    """Save embedding to database"""
+# In-process LRU of content hash -> embedding, in front of the embedding_cache table
+_memory_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_memory_cache_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def get_model():
+    """
+    Load the embedding model once per process (lightweight, ~80MB; ~25MB as int8 ONNX).
+    
+    Called from the FastAPI startup hook so the first request doesn't pay for it.
+    Intra-op threads are capped at EMBEDDING_NUM_THREADS so several workers don't
+    oversubscribe the CPU cores.
+    """
+    logger.info(f"Loading embedding model {HF_EMBEDDING_MODEL} ({EMBEDDING_RUNTIME}, {EMBEDDING_NUM_THREADS} threads)")
+    if EMBEDDING_RUNTIME == "onnx":
+        from onnx_encoder import OnnxSentenceEncoder
+        return OnnxSentenceEncoder(HF_EMBEDDING_MODEL, ONNX_CACHE_DIR, num_threads=EMBEDDING_NUM_THREADS)
+    
+    import torch
+    from sentence_transformers import SentenceTransformer
+    torch.set_num_threads(EMBEDDING_NUM_THREADS)
+    return SentenceTransformer(HF_EMBEDDING_MODEL)
+
+def to_db_vector(embedding) -> Any:
+    """Convert an embedding to the value bound to an embedding column"""
+    if VECTOR_BACKEND == "pgvector":
+        return np.asarray(embedding, dtype=np.float16)  # halfvec column
+    return np.asarray(embedding, dtype=np.float32).tolist()  # real[] column (psycopg2 adapts lists, not arrays)
+
+def from_db_vector(value) -> np.ndarray:
+    """Convert a value read from an embedding column to a float32 array"""
+    if hasattr(value, "to_numpy"):  # pgvector HalfVector
+        value = value.to_numpy()
+    return np.asarray(value, dtype=np.float32)
+
+def hash_content(text: str) -> str:
+    """Stable cache key for an embedded text (128-bit blake2b, faster than sha256)"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+def _remember(entries: Dict[str, np.ndarray]) -> None:
+    """Add embeddings to the in-process LRU, evicting the least recently used"""
+    with _memory_cache_lock:
+        for content_hash, embedding in entries.items():
+            _memory_cache[content_hash] = embedding
+            _memory_cache.move_to_end(content_hash)
+        while len(_memory_cache) > EMBEDDING_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+def _recall(content_hashes: List[str]) -> Dict[str, np.ndarray]:
+    """Embeddings already held in the in-process LRU"""
+    found = {}
+    with _memory_cache_lock:
+        for content_hash in content_hashes:
+            embedding = _memory_cache.get(content_hash)
+            if embedding is not None:
+                _memory_cache.move_to_end(content_hash)
+                found[content_hash] = embedding
+    return found
+
+def generate_embedding(text: str) -> np.ndarray:
+    """
+    Generate embedding vector for given text.
+    
+    Returns a float32, C-contiguous array that is passed as-is to the database
+    and the RAG search, instead of boxing every component into a Python float.
+    """
+    return generate_embeddings([text])[0]
+
+def _load_cached_embeddings(content_hashes: List[str]) -> Dict[str, np.ndarray]:
+    """Look up many embeddings in the persistent cache with a single query"""
     session = get_session()
     try:
-        embedding_record = TenantEmbedding(
-            tenant_id=tenant_id,
-            content=content,
-            embedding=embedding
-        )
-        session.add(embedding_record)
-        session.commit()
-        session.refresh(embedding_record)
-        return embedding_record
+        rows = session.execute(
+            select(EmbeddingCache.content_hash, EmbeddingCache.embedding).where(
+                EmbeddingCache.model_name == EMBEDDING_CACHE_MODEL,
+                EmbeddingCache.content_hash.in_(content_hashes)
+            )
+        ).all()
+        return {content_hash: from_db_vector(embedding) for content_hash, embedding in rows}
     finally:
         session.close()
+
+def _store_cached_embeddings(entries: Dict[str, np.ndarray]) -> None:
+    """Persist many embeddings with a single multi-row INSERT (Core, no ORM session)"""
+    with engine.begin() as conn:
+        conn.execute(
+            insert(EmbeddingCache.__table__)
+            .values([
+                {"model_name": EMBEDDING_CACHE_MODEL, "content_hash": content_hash, "embedding": to_db_vector(embedding)}
+                for content_hash, embedding in entries.items()
+            ])
+            .on_conflict_do_nothing()
+        )
+
+def generate_embeddings(texts: List[str]) -> np.ndarray:
+    """
+    Generate L2-normalized embeddings for many texts at once.
+    
+    Texts are resolved from the in-process LRU, then the embedding_cache table
+    (one query), and only the rest are encoded, in a single batched forward
+    pass instead of one model call per text.
+    
+    Returns: float32 array of shape (len(texts), dim), in input order
+    """
+    model = get_model()
+    if not texts:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    
+    content_hashes = [hash_content(text) for text in texts]
+    unique_hashes = list(dict.fromkeys(content_hashes))
+    cached = _recall(unique_hashes)
+    
+    uncached = [content_hash for content_hash in unique_hashes if content_hash not in cached]
+    if uncached:
+        try:
+            stored = _load_cached_embeddings(uncached)
+        except Exception as e:
+            logger.warning(f"Embedding cache lookup failed: {e}")
+            stored = {}
+        cached.update(stored)
+        _remember(stored)
+    
+    # Encode each distinct uncached text once
+    missing = {}
+    for content_hash, text in zip(content_hashes, texts):
+        if content_hash not in cached:
+            missing.setdefault(content_hash, text)
+    
+    if missing:
+        try:
+            # Normalize once here so similarity search is a plain inner product
+            encoded = model.encode(
+                list(missing.values()),
+                batch_size=EMBEDDING_BATCH_SIZE,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
+        except Exception as e:
+            logger.error(f"Error generating embeddings: {e}", exc_info=True)
+            raise
+        fresh = dict(zip(missing.keys(), np.asarray(encoded, dtype=np.float32)))
+        cached.update(fresh)
+        _remember(fresh)
+        try:
+            _store_cached_embeddings(fresh)
+        except Exception as e:
+            logger.warning(f"Embedding cache write failed: {e}")
+    
+    logger.debug(f"Embedded {len(texts)} texts, {len(missing)} required encoding")
+    # vstack copies, so callers never share the cached arrays
+    return np.vstack([cached[content_hash] for content_hash in content_hashes])
+
+def save_embedding(tenant_id: str, content: str, embedding: np.ndarray) -> int:
+    """
+    Save embedding to database in one INSERT ... RETURNING round-trip, returns its ID.
+    
+    Runs as a Core statement on a pooled connection: no Session, identity map or
+    ORM insert bookkeeping on the per-row hot path.
+    """
+    table = TenantEmbedding.__table__
+    with engine.begin() as conn:
+        embedding_id = conn.execute(
+            insert(table)
+            .values(tenant_id=tenant_id, content=content, embedding=to_db_vector(embedding))
+            .returning(table.c.id)
+        ).scalar_one()
+    add_to_tenant_cache(tenant_id, [embedding_id], [content], [embedding])
+    return embedding_id
+
+def save_embeddings(tenant_id: str, contents: List[str], embeddings: np.ndarray) -> List[int]:
+    """
+    Save many embeddings in one transaction, returns their IDs in order.
+    
+    Core executemany with RETURNING is sent as multi-row INSERTs
+    (SQLAlchemy insertmanyvalues), one round-trip per page of rows.
+    """
+    table = TenantEmbedding.__table__
+    with engine.begin() as conn:
+        embedding_ids = conn.execute(
+            insert(table).returning(table.c.id, sort_by_parameter_order=True),
+            [
+                {"tenant_id": tenant_id, "content": content, "embedding": to_db_vector(embedding)}
+                for content, embedding in zip(contents, embeddings)
+            ]
+        ).scalars().all()
+    add_to_tenant_cache(tenant_id, embedding_ids, contents, embeddings)
+    return list(embedding_ids)
@@ -1,15 +1,23 @@
 import httpx
 import asyncio
-from config import GEMINI_API_KEY, GEMINI_MODEL
+from config import (
+    GEMINI_API_KEY, GEMINI_BATCH_MAX_BYTES, GEMINI_BATCH_POLL_SECONDS, GEMINI_MODEL, GEMINI_MAX_CONCURRENCY,
+    GEMINI_MAX_OUTPUT_TOKENS, GEMINI_TIMEOUT_SECONDS
+)
 from tenacity import retry, stop_after_attempt, wait_exponential
 from concurrency import with_concurrency_limit
+from typing import Any, Callable, Dict, List, Optional
 import logging
-import json
+import orjson
 
 logger = logging.getLogger(__name__)
 
-# Gemini API endpoint
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models"
+# Gemini API endpoints
+GEMINI_API_ROOT = "https://generativelanguage.googleapis.com/v1beta"
+GEMINI_API_URL = f"{GEMINI_API_ROOT}/models"
+
+# Final states of a batch job (reported as BATCH_STATE_* or JOB_STATE_*)
+_BATCH_FINAL_STATES = {"SUCCEEDED", "FAILED", "CANCELLED", "EXPIRED"}
 
 # Global async client
 _http_client = None
@@ -18,7 +26,14 @@ def get_http_client() -> httpx.AsyncClient:
     """Get or create HTTP client"""
     global _http_client
     if _http_client is None:    
-        _http_client = httpx.AsyncClient(timeout=60.0)
+        # Keep one pooled connection per concurrent Gemini call so requests overlap
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(GEMINI_TIMEOUT_SECONDS, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=GEMINI_MAX_CONCURRENCY,
+                max_keepalive_connections=GEMINI_MAX_CONCURRENCY
+            )
+        )
     return _http_client
 
 async def close_http_client():
@@ -28,22 +43,74 @@ async def close_http_client():
         await _http_client.aclose()
         _http_client = None
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=2, max=10)
-)
-async def generate_cleaning_suggestion(context: str, row_data: str) -> str:
+class JsonObjectScanner:
     """
-    Generate cleaning suggestions using Google Gemini API (async with retry)
-    
-    Args:
-        context: Similar examples from database (RAG context)
-        row_data: The data row to clean (JSON formatted)
+    Incremental bracket-depth scanner for the first balanced JSON object in text.
     
-    Returns:
-        JSON string with cleaning suggestions
+    Text can be fed in pieces (e.g. streamed LLM output). Braces inside JSON
+    strings are ignored, so nested objects and values like "{x}" don't end the
+    object early. Balanced braces that don't parse as JSON (e.g. "{placeholder}"
+    in prose) are skipped and scanning resumes right after their opening brace.
     """
-    user_message = f"""You are a data cleaning expert. Analyze the following data row and provide cleaning suggestions.
+    
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._start = -1
+        self._in_string = False
+        self._escaped = False
+    
+    def feed(self, chunk: str) -> Optional[str]:
+        """Append text; returns the first complete top-level object once it is closed"""
+        self._text += chunk
+        while self._pos < len(self._text):
+            i = self._pos
+            self._pos += 1
+            char = self._text[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                # Quotes in prose around the object don't start a JSON string
+                self._in_string = self._depth > 0
+            elif char == "{":
+                if self._depth == 0:
+                    self._start = i
+                self._depth += 1
+            elif char == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    candidate = self._text[self._start:i + 1]
+                    try:
+                        orjson.loads(candidate)
+                        return candidate
+                    except orjson.JSONDecodeError:
+                        # Not JSON; an object may still start inside it
+                        self._pos = self._start + 1
+                        self._in_string = False
+                        self._escaped = False
+        return None
+
+def find_json_object(text: str) -> Optional[str]:
+    """First balanced top-level JSON object in text (e.g. an LLM reply wrapped in prose), or None"""
+    return JsonObjectScanner().feed(text)
+
+def _extract_text(result: Dict[str, Any]) -> str:
+    """Text of the first candidate in a (streamed) generateContent response"""
+    candidates = result.get("candidates") or []
+    if not candidates:
+        return ""
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return "".join(part.get("text", "") for part in parts)
+
+def build_prompt(context: str, row_data: str) -> str:
+    """Cleaning prompt for one row with its RAG context"""
+    return f"""You are a data cleaning expert. Analyze the following data row and provide cleaning suggestions.
 
 ## Context (similar previous rows):
 {context}
@@ -61,6 +128,51 @@ Provide your response as a JSON object with EXACTLY this structure (no markdown,
 }}
 
 If there are no issues, still return JSON with field "status" set to "clean"."""
+
+def _generate_content_request(prompt: str) -> Dict[str, Any]:
+    """GenerateContentRequest body for a prompt"""
+    return {
+        "contents": [
+            {
+                "parts": [
+                    {
+                        "text": prompt
+                    }
+                ]
+            }
+        ],
+        "generationConfig": {
+            "temperature": 0.7,
+            "topK": 40,
+            "topP": 0.95,
+            "maxOutputTokens": GEMINI_MAX_OUTPUT_TOKENS
+        }
+    }
+
+def _error_suggestion(message: str, details: str) -> str:
+    """Suggestion text recorded when no LLM reply could be obtained"""
+    return orjson.dumps({
+        "status": "error",
+        "message": message,
+        "details": details
+    }).decode()
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=10)
+)
+async def generate_cleaning_suggestion(context: str, row_data: str) -> str:
+    """
+    Generate cleaning suggestions using Google Gemini API (async with retry)
+    
+    Args:
+        context: Similar examples from database (RAG context)
+        row_data: The data row to clean (JSON formatted)
+    
+    Returns:
+        JSON string with cleaning suggestions
+    """
+    user_message = build_prompt(context, row_data)
     
     # Use concurrency limit to prevent rate limiting
     async def _call_gemini():
@@ -69,53 +181,50 @@ If there are no issues, still return JSON with field "status" set to "clean"."""
             
             client = get_http_client()
             
-            # Prepare request
-            url = f"{GEMINI_API_URL}/{GEMINI_MODEL}:generateContent"
+            # Prepare request (server-sent events so the reply can be parsed as it streams)
+            url = f"{GEMINI_API_URL}/{GEMINI_MODEL}:streamGenerateContent"
             headers = {
                 "Content-Type": "application/json",
                 "x-goog-api-key": GEMINI_API_KEY
             }
             
-            payload = {
-                "contents": [
-                    {
-                        "parts": [
-                            {
-                                "text": user_message
-                            }
-                        ]
-                    }
-                ],
-                "generationConfig": {
-                    "temperature": 0.7,
-                    "topK": 40,
-                    "topP": 0.95,
-                    "maxOutputTokens": 2048
-                }
-            }
-            
-            response = await client.post(url, json=payload, headers=headers)
-            response.raise_for_status()
+            payload = _generate_content_request(user_message)
             
-            result = response.json()
+            scanner = JsonObjectScanner()
+            chunks = []
+            async with client.stream("POST", url, params={"alt": "sse"}, json=payload, headers=headers) as response:
+                if response.is_error:
+                    await response.aread()
+                response.raise_for_status()
+                
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    chunk_text = _extract_text(orjson.loads(line[5:]))
+                    if not chunk_text:
+                        continue
+                    chunks.append(chunk_text)
+                    
+                    # Stop as soon as a complete JSON object has arrived; leaving the
+                    # stream context closes the connection and ends generation early
+                    json_text = scanner.feed(chunk_text)
+                    if json_text is not None:
+                        logger.debug(f"Raw API response: {''.join(chunks)}")
+                        logger.info("LLM suggestion generated successfully")
+                        return json_text
             
-            # Extract text from response
-            if "candidates" in result and len(result["candidates"]) > 0:
-                candidate = result["candidates"][0]
-                if "content" in candidate:
-                    for part in candidate["content"].get("parts", []):
-                        if "text" in part:
-                            response_text = part["text"]
-                            logger.debug(f"Raw API response: {response_text}")
-                            logger.info("LLM suggestion generated successfully")
-                            return response_text
+            if chunks:
+                response_text = "".join(chunks)
+                logger.debug(f"Raw API response: {response_text}")
+                logger.info("LLM suggestion generated (no complete JSON object)")
+                return response_text
             
             error_msg = "No valid response from Gemini"
             logger.error(error_msg)
             raise ValueError(error_msg)
             
         except httpx.HTTPStatusError as e:
-            logger.error(f"Gemini API HTTP error: {e.status_code} - {e.response.text}")
+            logger.error(f"Gemini API HTTP error: {e.response.status_code} - {e.response.text}")
             raise
         except Exception as e:
             logger.error(f"Error calling Gemini API: {e}", exc_info=True)
@@ -125,8 +234,146 @@ If there are no issues, still return JSON with field "status" set to "clean"."""
         return await with_concurrency_limit(_call_gemini())
     except Exception as e:
         logger.error(f"Failed to generate LLM suggestion after retries: {e}")
-        return json.dumps({
-            "status": "error",
-            "message": "LLM API call failed",
-            "details": str(e)
-        })
+        return _error_suggestion("LLM API call failed", str(e))
+
+async def generate_cleaning_suggestions_batch(
+    contexts: List[str],
+    row_datas: List[str],
+    display_name: str,
+    on_submitted: Optional[Callable[[str], None]] = None
+) -> List[str]:
+    """
+    Generate cleaning suggestions for many rows with Gemini batch jobs.
+    
+    Batch jobs are billed at half the per-request price and don't count against
+    the online rate limit, but complete asynchronously (minutes to hours), so
+    this suits bulk dataset uploads rather than the interactive path. Requests
+    are sent inline, split into as many jobs as needed to keep each submission
+    under GEMINI_BATCH_MAX_BYTES (Gemini caps inline batches at 20 MB).
+    
+    Args:
+        contexts: RAG context of each row
+        row_datas: The data rows to clean (JSON formatted)
+        display_name: Label of the batch jobs
+        on_submitted: Optional callback receiving each batch name once submitted
+    
+    Returns:
+        Suggestion text of each row, in input order (error JSON for failed requests
+        and for the rows of failed jobs; raises only if every job failed)
+    """
+    if not row_datas:
+        return []
+    
+    # Serialize each request once; the encoded sizes decide the split
+    requests = [
+        orjson.dumps({"request": _generate_content_request(build_prompt(context, row_data))})
+        for context, row_data in zip(contexts, row_datas)
+    ]
+    chunks = _chunk_by_size(requests, GEMINI_BATCH_MAX_BYTES)
+    
+    results = await asyncio.gather(*[
+        _run_batch(chunk, f"{display_name}-{number}" if len(chunks) > 1 else display_name, on_submitted)
+        for number, chunk in enumerate(chunks, start=1)
+    ], return_exceptions=True)
+    
+    failures = [result for result in results if isinstance(result, Exception)]
+    if len(failures) == len(results):
+        raise failures[0]
+    
+    # A failed job only costs its own rows; the other jobs' results are already paid for
+    suggestions = []
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            logger.error(f"Gemini batch job of {len(chunk)} requests failed: {result}")
+            suggestions.extend([_error_suggestion("LLM batch job failed", str(result))] * len(chunk))
+        else:
+            suggestions.extend(result)
+    return suggestions
+
+def _chunk_by_size(requests: List[bytes], max_bytes: int) -> List[List[bytes]]:
+    """Split serialized requests into consecutive chunks of at most max_bytes each"""
+    # Each request also gets a separator and a metadata key when submitted
+    overhead = 64
+    chunks: List[List[bytes]] = [[]]
+    size = overhead
+    for request in requests:
+        if chunks[-1] and size + len(request) + overhead > max_bytes:
+            chunks.append([])
+            size = overhead
+        chunks[-1].append(request)
+        size += len(request) + overhead
+    return chunks
+
+async def _run_batch(
+    requests: List[bytes],
+    display_name: str,
+    on_submitted: Optional[Callable[[str], None]]
+) -> List[str]:
+    """Submit one batch job, wait for it and return its suggestion texts in request order"""
+    batch_name = await _create_batch(requests, display_name)
+    logger.info(f"Submitted Gemini batch {batch_name} with {len(requests)} requests")
+    if on_submitted:
+        on_submitted(batch_name)
+    
+    while True:
+        batch = await _get_batch(batch_name)
+        state = batch.get("metadata", {}).get("state", "")
+        if batch.get("done") or state.rsplit("_", 1)[-1] in _BATCH_FINAL_STATES:
+            break
+        logger.debug(f"Gemini batch {batch_name} is {state}")
+        await asyncio.sleep(GEMINI_BATCH_POLL_SECONDS)
+    
+    if "error" in batch or not state.endswith("SUCCEEDED"):
+        raise RuntimeError(f"Gemini batch {batch_name} ended in state {state}: {batch.get('error')}")
+    
+    logger.info(f"Gemini batch {batch_name} completed")
+    return _batch_suggestions(batch, len(requests))
+
+async def _create_batch(requests: List[bytes], display_name: str) -> str:
+    """Submit serialized requests inline as one batch job, returns the batch name"""
+    # Responses keep request order; the keys let _batch_suggestions place them regardless
+    keyed = [
+        request[:-1] + b',"metadata":{"key":"' + str(index).encode() + b'"}}'
+        for index, request in enumerate(requests)
+    ]
+    body = (
+        b'{"batch":{"display_name":' + orjson.dumps(display_name)
+        + b',"input_config":{"requests":{"requests":[' + b",".join(keyed) + b"]}}}}"
+    )
+    # Not retried: a timed-out submission may still have created the job
+    response = await get_http_client().post(
+        f"{GEMINI_API_URL}/{GEMINI_MODEL}:batchGenerateContent",
+        content=body,
+        headers={"Content-Type": "application/json", "x-goog-api-key": GEMINI_API_KEY}
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content)["name"]
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=10)
+)
+async def _get_batch(batch_name: str) -> Dict[str, Any]:
+    """Current status (and, once done, results) of a batch job"""
+    response = await get_http_client().get(
+        f"{GEMINI_API_ROOT}/{batch_name}",
+        headers={"x-goog-api-key": GEMINI_API_KEY}
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+def _batch_suggestions(batch: Dict[str, Any], count: int) -> List[str]:
+    """Suggestion texts of a finished batch, placed by request key"""
+    inlined = batch.get("response", {}).get("inlinedResponses", [])
+    if isinstance(inlined, dict):
+        inlined = inlined.get("inlinedResponses", [])
+    
+    suggestions = [_error_suggestion("LLM batch response missing", batch.get("name", ""))] * count
+    for position, item in enumerate(inlined):
+        key = item.get("metadata", {}).get("key")
+        index = int(key) if key is not None else position
+        if "error" in item:
+            suggestions[index] = _error_suggestion("LLM batch request failed", str(item["error"].get("message")))
+        else:
+            suggestions[index] = _extract_text(item.get("response", {}))
+    return suggestions
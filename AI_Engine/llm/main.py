@@ -1,11 +1,15 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from cleaning import process_row
+from cleaning import process_row, process_rows_batch
 from async_cleaning import process_row_async
 from dataset_processor import get_processing_service
-from database import init_db
+from database import async_engine, get_async_session, init_db
 from llm import close_http_client
+from embeddings import get_model
+from rag import save_tenant_indexes
+from prometheus_client import make_asgi_app
 from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Dict, Any, List
 from uuid import UUID
 import logging
@@ -29,6 +33,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Prometheus scrape endpoint (e.g. semantic_cache_lookups_total)
+app.mount("/metrics", make_asgi_app())
+
 class RowPayload(BaseModel):
     tenantId: str
     datasetId: str
@@ -42,10 +49,12 @@ class DatasetPayload(BaseModel):
 
 @app.on_event("startup")
 def startup_event():
-    """Initialize database on startup"""
+    """Initialize database and load the embedding model on startup"""
     logger.info("Initializing database...")
     init_db()
     logger.info("Database initialized successfully")
+    logger.info("Loading embedding model...")
+    get_model()
     logger.info("FastAPI async engine ready")
 
 @app.on_event("shutdown")
@@ -53,9 +62,11 @@ async def shutdown_event():
     """Cleanup on shutdown"""
     logger.info("Shutting down FastAPI")
     await close_http_client()
+    await async_engine.dispose()
+    save_tenant_indexes()
 
 @app.post("/process-row")
-async def process_row_endpoint(payload: RowPayload):
+async def process_row_endpoint(payload: RowPayload, session: AsyncSession = Depends(get_async_session)):
     """
     Process a single data row for cleaning suggestions (SYNCHRONOUS).
     Kept for backward compatibility with existing integrations.
@@ -92,7 +103,7 @@ async def process_row_endpoint(payload: RowPayload):
     try:
         logger.info(f"Processing row for tenant: {payload.tenantId}, dataset: {payload.datasetId}")
         dataset_id = UUID(payload.datasetId)
-        result = await process_row_async(payload.tenantId, dataset_id, payload.row)
+        result = await process_row_async(payload.tenantId, dataset_id, payload.row, session)
         return {
             "tenantId": payload.tenantId,
             "datasetId": payload.datasetId,
@@ -106,7 +117,7 @@ async def process_row_endpoint(payload: RowPayload):
         raise HTTPException(status_code=500, detail=f"Error processing row: {str(e)}")
 
 @app.post("/process-row-async")
-async def process_row_async_endpoint(payload: RowPayload):
+async def process_row_async_endpoint(payload: RowPayload, session: AsyncSession = Depends(get_async_session)):
     """
     Process a single data row asynchronously for cleaning suggestions.
     Non-blocking async endpoint using httpx and thread pools.
@@ -137,7 +148,7 @@ async def process_row_async_endpoint(payload: RowPayload):
     try:
         logger.info(f"Processing row async for tenant: {payload.tenantId}, dataset: {payload.datasetId}")
         dataset_id = UUID(payload.datasetId)
-        result = await process_row_async(payload.tenantId, dataset_id, payload.row)
+        result = await process_row_async(payload.tenantId, dataset_id, payload.row, session)
         return {
             "tenantId": payload.tenantId,
             "datasetId": payload.datasetId,
@@ -187,22 +198,26 @@ async def process_rows_endpoint(payload: DatasetPayload):
         logger.info(f"Processing {len(payload.rows)} rows for tenant: {payload.tenantId}, dataset: {payload.datasetId}")
         dataset_id = UUID(payload.datasetId)
         
-        # Process all rows concurrently
+        # Embed, retrieve and call the LLM for all rows as one batch. LLM and parse
+        # failures come back per row as error suggestions rather than failing the batch
+        row_results = await process_rows_batch(payload.tenantId, dataset_id, payload.rows)
+        
         results = []
-        for idx, row in enumerate(payload.rows):
-            try:
-                result = await process_row_async(payload.tenantId, dataset_id, row)
+        for idx, result in enumerate(row_results):
+            suggestion = result["suggestion"]
+            if suggestion.get("status") == "error":
+                logger.error(f"Error processing row {idx}: {suggestion.get('message')}")
                 results.append({
                     "row_index": idx,
-                    "status": "success",
-                    "suggestion": result
+                    "status": "error",
+                    "suggestion": suggestion,
+                    "error": suggestion.get("message")
                 })
-            except Exception as e:
-                logger.error(f"Error processing row {idx}: {str(e)}")
+            else:
                 results.append({
                     "row_index": idx,
-                    "status": "error",
-                    "error": str(e)
+                    "status": "success",
+                    "suggestion": result
                 })
         
         processed_count = sum(1 for r in results if r["status"] == "success")
@@ -244,7 +259,10 @@ async def root():
             "POST /process-row-async": "Process a single row (async, non-blocking)",
             "POST /process-rows": "Process multiple rows (async, bulk processing)",
             "POST /process-dataset": "Process entire dataset with background tasks and streaming",
+            "POST /process-dataset-batch": "Process entire dataset through the Gemini batch API (returns a job ID)",
+            "GET /jobs/{job_id}": "Status of a batch processing job",
             "GET /health": "Health check with version info",
+            "GET /metrics": "Prometheus metrics (semantic cache hit rate)",
             "GET /docs": "Interactive API documentation (Swagger UI)",
             "GET /redoc": "Alternative API documentation (ReDoc)"
         }
@@ -299,3 +317,56 @@ async def process_dataset_endpoint(payload: DatasetPayload):
     except Exception as e:
         logger.error(f"Error starting dataset processing: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error starting dataset processing: {str(e)}")
+
+@app.post("/process-dataset-batch")
+async def process_dataset_batch_endpoint(payload: DatasetPayload):
+    """
+    Process an entire dataset offline through the Gemini batch API.
+    
+    Batch jobs cost half as much as per-row calls and are not rate limited,
+    but finish asynchronously (minutes to hours). Use /process-dataset for
+    real-time streaming and /process-row for interactive requests.
+    
+    Args:
+        tenantId: Tenant identifier for multi-tenant isolation
+        datasetId: UUID of the dataset
+        rows: List of data rows to process
+    
+    Returns:
+        {
+          "job_id": str,
+          "status": "queued",
+          "total_rows": int,
+          ...
+        }
+        Poll GET /jobs/{job_id} for progress; results are stored in cleaning_results.
+    """
+    try:
+        logger.info(
+            f"Batch dataset processing requested - tenant: {payload.tenantId}, "
+            f"dataset: {payload.datasetId}, rows: {len(payload.rows)}"
+        )
+        
+        dataset_id = UUID(payload.datasetId)
+        return get_processing_service().submit_batch_job(payload.tenantId, dataset_id, payload.rows)
+        
+    except ValueError as e:
+        logger.error(f"Invalid dataset ID format: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Invalid dataset ID format: {str(e)}")
+    except Exception as e:
+        logger.error(f"Error starting batch dataset processing: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error starting batch dataset processing: {str(e)}")
+
+@app.get("/jobs/{job_id}")
+async def get_job_endpoint(job_id: str):
+    """
+    Status of a batch processing job.
+    
+    Returns:
+        {"job_id", "status" (queued, running, completed, failed, cancelled), "total_rows",
+         "processed_rows", "batch_names", "error", "finished_at", ...}
+    """
+    job = get_processing_service().get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return job
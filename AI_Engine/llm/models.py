@@ -1,14 +1,39 @@
-from sqlalchemy import Column, String, Integer, Float, TIMESTAMP, JSON, func
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Column, String, Integer, Float, TIMESTAMP, func
+from sqlalchemy.dialects.postgresql import UUID, JSONB
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import ARRAY, REAL
 from sqlalchemy import Index
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
 from sqlalchemy_utils import UUIDType
+from config import EMBEDDING_DIM, VECTOR_BACKEND
 
 Base = declarative_base()
 
+def embedding_type():
+    """Column type for stored embeddings, depending on the configured vector backend"""
+    if VECTOR_BACKEND == "pgvector":
+        # FP16 halves the bytes read per distance computation (requires pgvector >= 0.7)
+        from pgvector.sqlalchemy import HALFVEC
+        return HALFVEC(EMBEDDING_DIM)
+    return ARRAY(REAL)  # float4[], half the size of double precision
+
+_tenant_embedding_indexes = [Index("idx_tenant_embeddings_tenant", "tenant_id")]
+if VECTOR_BACKEND == "pgvector":
+    # Embeddings are L2-normalized at ingest, so inner product ranks identically to cosine
+    _tenant_embedding_indexes.append(
+        Index(
+            "idx_tenant_embeddings_embedding_hnsw_ip",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embedding": "halfvec_ip_ops"},
+        )
+    )
+else:
+    # In-process matrices/indexes are refreshed with "tenant_id = ? AND id > ?" before each query
+    _tenant_embedding_indexes.append(Index("idx_tenant_embeddings_tenant_id", "tenant_id", "id"))
+
 # ------------------------------
 # Tenant Embeddings Table
 # ------------------------------
@@ -18,12 +43,22 @@ class TenantEmbedding(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     tenant_id = Column(String(255), nullable=False)
     content = Column(String, nullable=False)           # The row text or context
-    embedding = Column(ARRAY(Float), nullable=False)   # Store embeddings as array
+    embedding = Column(embedding_type(), nullable=False)  # L2-normalized embedding
     created_at = Column(TIMESTAMP, server_default=func.now())
 
-    __table_args__ = (
-        Index("idx_tenant_embeddings_tenant", "tenant_id"),
-    )
+    __table_args__ = tuple(_tenant_embedding_indexes)
+
+
+# ------------------------------
+# Embedding Cache Table
+# ------------------------------
+class EmbeddingCache(Base):
+    __tablename__ = "embedding_cache"
+
+    model_name = Column(String(255), primary_key=True)
+    content_hash = Column(String(64), primary_key=True)   # blake2b-128 hex of the embedded text
+    embedding = Column(embedding_type(), nullable=False)
+    created_at = Column(TIMESTAMP, server_default=func.now())
 
 
 # ------------------------------
@@ -35,14 +70,17 @@ class CleaningResult(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     tenant_id = Column(String(255), nullable=False)
     dataset_id = Column(UUIDType(binary=False), nullable=False)
-    row_data = Column(JSON, nullable=False)           # Original row JSON
-    ai_suggestion = Column(JSON, nullable=False)     # LLM-generated cleaning suggestion
+    row_data = Column(JSONB, nullable=False)          # Original row JSON
+    ai_suggestion = Column(JSONB, nullable=False)    # LLM-generated cleaning suggestion
     confidence = Column(Float, nullable=True)        # Optional confidence score
     status = Column(String(50), default="processed")
+    content_hash = Column(String(64), nullable=True)  # blake2b-128 hex of the serialized row
     created_at = Column(TIMESTAMP, server_default=func.now())
 
     __table_args__ = (
         Index("idx_cleaning_results_tenant_dataset", "tenant_id", "dataset_id"),
+        # Semantic cache lookups: prior suggestion for the same row content
+        Index("idx_cleaning_results_tenant_hash", "tenant_id", "content_hash"),
     )
 
 
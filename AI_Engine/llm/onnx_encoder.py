@@ -0,0 +1,94 @@
+from pathlib import Path
+from typing import List, Union
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+QUANTIZED_FILE_NAME = "model_quantized.onnx"
+
+class OnnxSentenceEncoder:
+    """
+    Int8-quantized ONNX Runtime replacement for SentenceTransformer.
+    
+    The Hugging Face model is exported to ONNX and dynamically quantized to int8
+    on first use (cached under cache_dir). encode() mirrors the subset of the
+    SentenceTransformer.encode signature used in this service: mean pooling over
+    the attention mask, optional L2 normalization, NumPy output.
+    """
+    
+    def __init__(self, model_name: str, cache_dir: str, max_seq_length: int = 256, num_threads: int = 0):
+        from onnxruntime import SessionOptions
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        
+        model_dir = Path(cache_dir) / model_name.replace("/", "__")
+        if not (model_dir / QUANTIZED_FILE_NAME).exists():
+            _export_quantized(model_name, model_dir)
+        
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        session_options = SessionOptions()
+        session_options.intra_op_num_threads = num_threads  # 0 lets ONNX Runtime use all cores
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir,
+            file_name=QUANTIZED_FILE_NAME,
+            session_options=session_options
+        )
+        self.max_seq_length = max_seq_length
+        logger.info(f"Loaded int8 ONNX embedding model from {model_dir}")
+    
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.config.hidden_size
+    
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: int = 32,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = False
+    ) -> np.ndarray:
+        """Embed one text (returns shape (dim,)) or a list of texts (returns shape (n, dim))"""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(
+                texts[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np"
+            )
+            token_embeddings = self.model(**inputs).last_hidden_state
+            
+            # Mean pooling over real (non-padding) tokens
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            summed = (token_embeddings * mask).sum(axis=1)
+            batches.append((summed / np.clip(mask.sum(axis=1), 1e-9, None)).astype(np.float32))
+        
+        if batches:
+            embeddings = np.vstack(batches)
+        else:
+            embeddings = np.empty((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        
+        return embeddings[0] if single else embeddings
+
+def _export_quantized(model_name: str, model_dir: Path) -> None:
+    """Export a Hugging Face model to ONNX and quantize its weights to int8 (dynamic, VNNI)"""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+    
+    logger.info(f"Exporting {model_name} to int8 ONNX in {model_dir} (one-time)")
+    export_dir = model_dir / "fp32"
+    ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(export_dir)
+    
+    quantizer = ORTQuantizer.from_pretrained(export_dir)
+    quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=model_dir, quantization_config=quantization_config)
+    
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(model_dir)
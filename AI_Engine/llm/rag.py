@@ -1,50 +1,452 @@
+from sqlalchemy import or_, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import get_session
 from models import TenantEmbedding
-from typing import List
+from config import EMBEDDING_DIM, HNSW_EF_SEARCH, HNSW_ITERATIVE_SCAN, USEARCH_INDEX_DIR, VECTOR_BACKEND, VECTOR_REFRESH_LOOKBACK
+from rag_kernels import inner_products
+from typing import Dict, Iterable, List, Sequence, Tuple
+from pathlib import Path
+import asyncio
+import hashlib
+import os
+import threading
 import numpy as np
 import logging
 
 logger = logging.getLogger(__name__)
 
-def compute_cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
-    """Compute cosine similarity between two vectors"""
-    arr1 = np.array(vec1)
-    arr2 = np.array(vec2)
+# Stored and query embeddings are L2-normalized, so inner product equals cosine similarity
+
+class TenantCache:
+    """
+    Materialized embedding matrix of one tenant for the numpy backend.
+    
+    Rows live in a contiguous float32 buffer that grows by doubling, so appends
+    are amortized O(d) and queries are a single in-memory matrix-vector product.
+    Rows with IDs above max_id_seen are pulled from the database before each
+    query, which also picks up rows written by other workers. Rows committed
+    after a higher ID are caught by diffing the IDs (only) of the last
+    VECTOR_REFRESH_LOOKBACK against the cached ones.
+    """
+    
+    def __init__(self, dim: int):
+        self._buffer = np.empty((0, dim), dtype=np.float32)
+        self._size = 0
+        self._ids = set()
+        self.contents: List[str] = []
+        self.max_id_seen = 0
+        self.lock = threading.Lock()
     
-    # Normalize vectors
-    arr1_norm = arr1 / (np.linalg.norm(arr1) + 1e-8)
-    arr2_norm = arr2 / (np.linalg.norm(arr2) + 1e-8)
+    def append(self, ids: Sequence[int], contents: Sequence[str], embeddings: Iterable) -> None:
+        """Add rows not cached yet (caller holds self.lock)"""
+        new_rows = [
+            (row_id, content, embedding)
+            for row_id, content, embedding in zip(ids, contents, embeddings)
+            if row_id not in self._ids
+        ]
+        if not new_rows:
+            return
+        
+        needed = self._size + len(new_rows)
+        if needed > len(self._buffer):
+            grown = np.empty((max(needed, 2 * len(self._buffer)), self._buffer.shape[1]), dtype=np.float32)
+            grown[:self._size] = self._buffer[:self._size]
+            self._buffer = grown
+        
+        for row_id, content, embedding in new_rows:
+            self._buffer[self._size] = embedding
+            self._size += 1
+            self._ids.add(row_id)
+            self.contents.append(content)
+            self.max_id_seen = max(self.max_id_seen, row_id)
     
-    return float(np.dot(arr1_norm, arr2_norm))
+    def missing_ids(self, ids: Iterable[int]) -> List[int]:
+        """IDs not cached yet"""
+        with self.lock:
+            return [row_id for row_id in ids if row_id not in self._ids]
+    
+    def snapshot(self) -> Tuple[np.ndarray, List[str]]:
+        """
+        Current (matrix, contents) without copying. Later appends only write
+        past the snapshot's rows (or into a new buffer), so it stays valid.
+        """
+        return self._buffer[:self._size], self.contents
 
-def retrieve_similar(tenant_id: str, embedding: List[float], top_k: int = 3) -> List[str]:
-    """Retrieve similar embeddings from database using cosine similarity"""
-    session = get_session()
+class TenantIndex:
+    """
+    In-process USearch HNSW index of one tenant for the usearch backend.
+    
+    Keys are tenant_embeddings IDs and only vectors are held, so a query is a
+    SIMD graph search followed by one lookup of the top_k contents by ID. The
+    index is restored from its last snapshot on first use; rows with IDs above
+    max_id_seen, plus window IDs missing from the index (see TenantCache), are
+    pulled from the database before each query.
+    """
+    
+    def __init__(self, tenant_id: str, dim: int):
+        from usearch.index import Index
+        
+        self.path = Path(USEARCH_INDEX_DIR) / f"{hashlib.blake2b(tenant_id.encode('utf-8'), digest_size=16).hexdigest()}.usearch"
+        # Embeddings are L2-normalized, so "ip" ranks like cosine; graph parameters match the pgvector index
+        self.index = Index(
+            ndim=dim, metric="ip", dtype="f16",
+            connectivity=16, expansion_add=64, expansion_search=HNSW_EF_SEARCH
+        )
+        if self.path.exists():
+            self.index.load(str(self.path))
+        self.max_id_seen = int(np.asarray(self.index.keys).max()) if len(self.index) else 0
+        self.dirty = False
+        self.lock = threading.Lock()
+        self._save_lock = threading.Lock()
+    
+    def missing_ids(self, ids: Sequence[int]) -> List[int]:
+        """IDs not indexed yet"""
+        keys = np.asarray(ids, dtype=np.uint64)
+        if not len(keys):
+            return []
+        with self.lock:
+            contained = np.asarray(self.index.contains(keys), dtype=bool)
+        return [int(key) for key in keys[~contained]]
+    
+    def add(self, ids: Sequence[int], embeddings: Iterable) -> None:
+        """Add vectors not indexed yet (caller holds self.lock)"""
+        keys = np.asarray(ids, dtype=np.uint64)
+        if not len(keys):
+            return
+        fresh = ~np.asarray(self.index.contains(keys), dtype=bool)
+        if fresh.any():
+            # Only convert the rows being added (refreshes mostly re-read indexed ones)
+            vectors = np.asarray([
+                np.asarray(embedding, dtype=np.float32)
+                for embedding, is_fresh in zip(embeddings, fresh) if is_fresh
+            ])
+            self.index.add(keys[fresh], vectors)
+            self.dirty = True
+        self.max_id_seen = max(self.max_id_seen, int(keys.max()))
+    
+    def search(self, embedding: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        """(id, similarity) of the approximate top_k neighbours, best first"""
+        with self.lock:
+            if not len(self.index):
+                return []
+            matches = self.index.search(np.asarray(embedding, dtype=np.float32), top_k)
+        # USearch "ip" distance is 1 - inner product
+        return [(int(key), 1.0 - float(distance)) for key, distance in zip(matches.keys, matches.distances)]
+    
+    def save(self) -> None:
+        """
+        Snapshot the index to disk. The index is copied under the lock and the
+        copy written to a temp file outside it (then renamed into place), so
+        queries and inserts are not blocked by disk I/O.
+        """
+        with self._save_lock:
+            with self.lock:
+                snapshot = self.index.copy()
+                self.dirty = False
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+                snapshot.save(str(tmp_path))
+                os.replace(tmp_path, self.path)
+            except Exception:
+                self.dirty = True
+                raise
+
+_tenant_caches: Dict[str, TenantCache] = {}
+_tenant_indexes: Dict[str, TenantIndex] = {}
+# Guards the registries only; each TenantCache / TenantIndex has its own lock,
+# so work on one tenant never blocks the others
+_tenant_cache_lock = threading.Lock()
+
+def add_to_tenant_cache(tenant_id: str, ids: Sequence[int], contents: Sequence[str], embeddings: Iterable) -> None:
+    """Append newly saved embeddings to a tenant's in-process matrix or index, if it is loaded"""
+    with _tenant_cache_lock:
+        cache = _tenant_caches.get(tenant_id)
+        index = _tenant_indexes.get(tenant_id)
+    if cache is not None:
+        with cache.lock:
+            cache.append(ids, contents, embeddings)
+    if index is not None:
+        with index.lock:
+            index.add(ids, embeddings)
+
+def save_tenant_indexes() -> None:
+    """Snapshot changed USearch indexes to USEARCH_INDEX_DIR (called on shutdown)"""
+    with _tenant_cache_lock:
+        indexes = list(_tenant_indexes.items())
+    for tenant_id, index in indexes:
+        if index.dirty:
+            try:
+                index.save()
+            except Exception as e:
+                logger.error(f"Failed to save USearch index of tenant {tenant_id}: {e}")
+
+def retrieve_similar(tenant_id: str, embedding: np.ndarray, top_k: int = 3) -> List[str]:
+    """Retrieve the contents of the top_k most similar tenant embeddings"""
+    return [content for content, _ in retrieve_similar_scored(tenant_id, embedding, top_k)]
+
+def retrieve_similar_scored(tenant_id: str, embedding: np.ndarray, top_k: int = 3) -> List[Tuple[str, float]]:
+    """Retrieve (content, cosine similarity) of the top_k most similar tenant embeddings, best first"""
+    if VECTOR_BACKEND == "pgvector":
+        return _retrieve_similar_pgvector(tenant_id, embedding, top_k)
+    if VECTOR_BACKEND == "usearch":
+        return _retrieve_similar_usearch(tenant_id, embedding, top_k)
+    return _retrieve_similar_numpy(tenant_id, embedding, top_k)
+
+async def retrieve_similar_async(
+    session: AsyncSession,
+    tenant_id: str,
+    embedding: np.ndarray,
+    top_k: int = 3
+) -> List[str]:
+    """Async variant of retrieve_similar running on the caller's session"""
+    return [content for content, _ in await retrieve_similar_scored_async(session, tenant_id, embedding, top_k)]
+
+async def retrieve_similar_scored_async(
+    session: AsyncSession,
+    tenant_id: str,
+    embedding: np.ndarray,
+    top_k: int = 3
+) -> List[Tuple[str, float]]:
+    """Async variant of retrieve_similar_scored running on the caller's session"""
     try:
-        # Get all embeddings for the tenant
-        all_embeddings = session.query(
-            TenantEmbedding.content,
-            TenantEmbedding.embedding
-        ).filter(
-            TenantEmbedding.tenant_id == tenant_id
-        ).all()
-        
-        if not all_embeddings:
+        if VECTOR_BACKEND == "pgvector":
+            for statement in _hnsw_settings_statements():
+                await session.execute(statement)
+            rows = (await session.execute(_similar_contents_statement(tenant_id, embedding, top_k))).all()
+            scored = _scored_rows(rows)
+        elif VECTOR_BACKEND == "usearch":
+            index = await asyncio.to_thread(_tenant_index, tenant_id)
+            max_id_seen = index.max_id_seen
+            window_ids = (await session.scalars(_window_ids_statement(tenant_id, max_id_seen))).all() if max_id_seen else []
+            missing_ids = await asyncio.to_thread(index.missing_ids, window_ids)
+            rows = (await session.execute(_new_tenant_vectors_statement(tenant_id, max_id_seen, missing_ids))).all()
+            neighbours = await asyncio.to_thread(_search_indexed, tenant_id, index, rows, embedding, top_k)
+            contents = dict((await session.execute(_contents_by_id_statement(tenant_id, neighbours))).all()) if neighbours else {}
+            scored = _join_contents(neighbours, contents)
+        else:
+            # Registry and per-tenant locks can wait on other threads, and ranking is a
+            # full matrix product: keep both off the event loop
+            cache = await asyncio.to_thread(_tenant_cache, tenant_id)
+            max_id_seen = cache.max_id_seen
+            window_ids = (await session.scalars(_window_ids_statement(tenant_id, max_id_seen))).all() if max_id_seen else []
+            missing_ids = await asyncio.to_thread(cache.missing_ids, window_ids)
+            rows = (await session.execute(_new_tenant_rows_statement(tenant_id, max_id_seen, missing_ids))).all()
+            scored = await asyncio.to_thread(_rank_cached, cache, rows, embedding, top_k)
+        
+        if not scored:
             logger.warning(f"No embeddings found for tenant: {tenant_id}")
-            return []
+        return scored
         
-        # Compute similarities and sort
-        similarities = []
-        for content, db_embedding in all_embeddings:
-            similarity = compute_cosine_similarity(embedding, db_embedding)
-            similarities.append((content, similarity))
+    except Exception as e:
+        logger.error(f"Error retrieving similar embeddings: {e}", exc_info=True)
+        await session.rollback()
+        return []
+
+def _hnsw_settings_statements():
+    """
+    HNSW search settings; SET LOCAL scopes them to the current transaction.
+    
+    ef_search trades recall for speed. Iterative scans (pgvector 0.8+) keep
+    reading the index until top_k rows pass the tenant filter, up to
+    hnsw.max_scan_tuples; strict_order returns them in exact distance order.
+    """
+    statements = [text(f"SET LOCAL hnsw.ef_search = {int(HNSW_EF_SEARCH)}")]
+    if HNSW_ITERATIVE_SCAN in ("relaxed_order", "strict_order"):
+        statements.append(text(f"SET LOCAL hnsw.iterative_scan = {HNSW_ITERATIVE_SCAN}"))
+    return statements
+
+def _similar_contents_statement(tenant_id: str, embedding: np.ndarray, top_k: int):
+    """Nearest neighbours via the pgvector HNSW index (<#> negative inner product)"""
+    distance = TenantEmbedding.embedding.max_inner_product(embedding)
+    return (
+        select(TenantEmbedding.content, distance)
+        .where(TenantEmbedding.tenant_id == tenant_id)
+        .order_by(distance)
+        .limit(top_k)
+    )
+
+def _scored_rows(rows) -> List[Tuple[str, float]]:
+    """(content, <#> distance) rows to (content, similarity); <#> is the negated inner product"""
+    return [(content, -float(distance)) for content, distance in rows]
+
+def _window_ids_statement(tenant_id: str, max_id_seen: int):
+    """
+    IDs of the tenant's last VECTOR_REFRESH_LOOKBACK rows up to max_id_seen, to find rows
+    committed after a higher ID (answered from the (tenant_id, id) index, no embeddings read)
+    """
+    return select(TenantEmbedding.id).where(
+        TenantEmbedding.tenant_id == tenant_id,
+        TenantEmbedding.id > max_id_seen - VECTOR_REFRESH_LOOKBACK,
+        TenantEmbedding.id <= max_id_seen
+    )
+
+def _new_rows_condition(after_id: int, missing_ids: List[int]):
+    """Rows above the watermark plus the ones missing below it"""
+    if missing_ids:
+        return or_(TenantEmbedding.id > after_id, TenantEmbedding.id.in_(missing_ids))
+    return TenantEmbedding.id > after_id
+
+def _new_tenant_rows_statement(tenant_id: str, after_id: int, missing_ids: List[int]):
+    """Tenant embeddings not yet in the in-process matrix (all of them on a cold start)"""
+    return (
+        select(TenantEmbedding.id, TenantEmbedding.content, TenantEmbedding.embedding)
+        .where(TenantEmbedding.tenant_id == tenant_id, _new_rows_condition(after_id, missing_ids))
+        .order_by(TenantEmbedding.id)
+    )
+
+def _new_tenant_vectors_statement(tenant_id: str, after_id: int, missing_ids: List[int]):
+    """Tenant vectors not yet in the in-process index (contents are fetched per query instead)"""
+    return (
+        select(TenantEmbedding.id, TenantEmbedding.embedding)
+        .where(TenantEmbedding.tenant_id == tenant_id, _new_rows_condition(after_id, missing_ids))
+        .order_by(TenantEmbedding.id)
+    )
+
+def _contents_by_id_statement(tenant_id: str, neighbours: List[Tuple[int, float]]):
+    """Contents of the neighbours found in the in-process index (tenant-scoped in case a snapshot is stale)"""
+    return (
+        select(TenantEmbedding.id, TenantEmbedding.content)
+        .where(
+            TenantEmbedding.tenant_id == tenant_id,
+            TenantEmbedding.id.in_([row_id for row_id, _ in neighbours])
+        )
+    )
+
+def _retrieve_similar_pgvector(tenant_id: str, embedding: np.ndarray, top_k: int) -> List[Tuple[str, float]]:
+    """Nearest neighbours via the pgvector HNSW index"""
+    session = get_session()
+    try:
+        for statement in _hnsw_settings_statements():
+            session.execute(statement)
+        scored = _scored_rows(session.execute(_similar_contents_statement(tenant_id, embedding, top_k)).all())
         
-        # Sort by similarity (descending) and return top_k
-        similarities.sort(key=lambda x: x[1], reverse=True)
-        return [content for content, _ in similarities[:top_k]]
+        if not scored:
+            logger.warning(f"No embeddings found for tenant: {tenant_id}")
+        return scored
         
     except Exception as e:
         logger.error(f"Error retrieving similar embeddings: {e}", exc_info=True)
         return []
     finally:
         session.close()
+
+def _retrieve_similar_numpy(tenant_id: str, embedding: np.ndarray, top_k: int) -> List[Tuple[str, float]]:
+    """Nearest neighbours computed in-process against the materialized tenant matrix"""
+    try:
+        cache = _tenant_cache(tenant_id)
+        session = get_session()
+        try:
+            max_id_seen = cache.max_id_seen
+            window_ids = session.scalars(_window_ids_statement(tenant_id, max_id_seen)).all() if max_id_seen else []
+            rows = session.execute(
+                _new_tenant_rows_statement(tenant_id, max_id_seen, cache.missing_ids(window_ids))
+            ).all()
+        finally:
+            session.close()
+        
+        scored = _rank_cached(cache, rows, embedding, top_k)
+        if not scored:
+            logger.warning(f"No embeddings found for tenant: {tenant_id}")
+        return scored
+        
+    except Exception as e:
+        logger.error(f"Error retrieving similar embeddings: {e}", exc_info=True)
+        return []
+
+def _retrieve_similar_usearch(tenant_id: str, embedding: np.ndarray, top_k: int) -> List[Tuple[str, float]]:
+    """Approximate nearest neighbours via the tenant's in-process USearch HNSW index"""
+    try:
+        index = _tenant_index(tenant_id)
+        session = get_session()
+        try:
+            max_id_seen = index.max_id_seen
+            window_ids = session.scalars(_window_ids_statement(tenant_id, max_id_seen)).all() if max_id_seen else []
+            rows = session.execute(
+                _new_tenant_vectors_statement(tenant_id, max_id_seen, index.missing_ids(window_ids))
+            ).all()
+            neighbours = _search_indexed(tenant_id, index, rows, embedding, top_k)
+            contents = dict(session.execute(_contents_by_id_statement(tenant_id, neighbours)).all()) if neighbours else {}
+        finally:
+            session.close()
+        
+        scored = _join_contents(neighbours, contents)
+        if not scored:
+            logger.warning(f"No embeddings found for tenant: {tenant_id}")
+        return scored
+        
+    except Exception as e:
+        logger.error(f"Error retrieving similar embeddings: {e}", exc_info=True)
+        return []
+
+def _tenant_index(tenant_id: str) -> TenantIndex:
+    """Get or restore the USearch index of a tenant (blocking: may load a snapshot from disk)"""
+    with _tenant_cache_lock:
+        index = _tenant_indexes.get(tenant_id)
+    if index is None:
+        # Load outside the registry lock; if two threads race, the first one registered wins
+        loaded = TenantIndex(tenant_id, EMBEDDING_DIM)
+        with _tenant_cache_lock:
+            index = _tenant_indexes.setdefault(tenant_id, loaded)
+    return index
+
+def _search_indexed(tenant_id: str, index: TenantIndex, new_rows, embedding: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+    """Fold newly fetched (id, embedding) rows into the index, then search it"""
+    if new_rows:
+        with index.lock:
+            cold_start = not len(index.index)
+            index.add(
+                [row_id for row_id, _ in new_rows],
+                [db_embedding for _, db_embedding in new_rows]
+            )
+        if cold_start:
+            # Building from the database is the expensive part; snapshot it right away
+            try:
+                index.save()
+            except Exception as e:
+                logger.warning(f"Failed to save USearch index of tenant {tenant_id}: {e}")
+    return index.search(embedding, top_k)
+
+def _join_contents(neighbours: List[Tuple[int, float]], contents: Dict[int, str]) -> List[Tuple[str, float]]:
+    """(id, similarity) neighbours to (content, similarity), keeping rank order"""
+    return [(contents[row_id], similarity) for row_id, similarity in neighbours if row_id in contents]
+
+def _tenant_cache(tenant_id: str) -> TenantCache:
+    """Get or create the materialized matrix of a tenant"""
+    with _tenant_cache_lock:
+        cache = _tenant_caches.get(tenant_id)
+        if cache is None:
+            cache = _tenant_caches[tenant_id] = TenantCache(EMBEDDING_DIM)
+        return cache
+
+def _rank_cached(cache: TenantCache, new_rows, embedding: np.ndarray, top_k: int) -> List[Tuple[str, float]]:
+    """Fold newly fetched (id, content, embedding) rows into the cache, then rank it"""
+    with cache.lock:
+        if new_rows:
+            cache.append(
+                [row_id for row_id, _, _ in new_rows],
+                [content for _, content, _ in new_rows],
+                [db_embedding for _, _, db_embedding in new_rows]
+            )
+        matrix, contents = cache.snapshot()
+    
+    if not len(matrix):
+        return []
+    similarities = inner_products(matrix, np.asarray(embedding, dtype=np.float32))
+    return [(contents[i], float(similarities[i])) for i in _top_k_indices(similarities, top_k)]
+
+def _top_k_indices(similarities: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    Indices of the top_k highest similarities, best first.
+    
+    O(N) argpartition selects the survivors and only those k are sorted. The
+    partition runs on the array itself (kth from the end) rather than on a
+    negated copy, so no N-sized temporary is allocated per query.
+    """
+    n = len(similarities)
+    if top_k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if top_k >= n:
+        return np.argsort(similarities)[::-1]
+    candidates = np.argpartition(similarities, n - top_k)[n - top_k:]
+    return candidates[np.argsort(similarities[candidates])[::-1]]
@@ -0,0 +1,38 @@
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# numba is optional: without it the NumPy (BLAS) matrix-vector product is used
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    logger.info("numba not installed, using NumPy for similarity scoring")
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _inner_products_jit(matrix, query):
+        n, d = matrix.shape
+        out = np.empty(n, np.float32)
+        for i in prange(n):
+            s = np.float32(0.0)
+            for j in range(d):
+                s += matrix[i, j] * query[j]
+            out[i] = s
+        return out
+
+def inner_products(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """
+    Score a query against every row of an embedding matrix.
+    
+    Args:
+        matrix: C-contiguous float32 array of shape (n, dim), L2-normalized rows
+        query: float32 array of shape (dim,), L2-normalized
+    
+    Returns:
+        float32 array of shape (n,) with the cosine similarity of each row
+    """
+    if njit is None:
+        return matrix @ query
+    return _inner_products_jit(matrix, query)
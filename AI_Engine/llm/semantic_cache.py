@@ -0,0 +1,101 @@
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from prometheus_client import Counter
+from database import get_session
+from embeddings import hash_content
+from models import CleaningResult
+from config import SEMANTIC_CACHE_THRESHOLD
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Near-duplicate rows reuse an earlier suggestion instead of a Gemini call. The neighbours
+# come from the RAG lookup the row needs anyway (HNSW index or in-process search), so a
+# lookup costs one indexed query on cleaning_results by content hash.
+
+SEMANTIC_CACHE_LOOKUPS = Counter(
+    "semantic_cache_lookups_total",
+    "Semantic LLM cache lookups by result",
+    ["result"]
+)
+
+def _cached_suggestions_statement(tenant_id: str, content_hashes: List[str]):
+    """Latest usable suggestion stored for each of the given row contents (DISTINCT ON)"""
+    return (
+        select(CleaningResult.content_hash, CleaningResult.ai_suggestion)
+        .where(
+            CleaningResult.tenant_id == tenant_id,
+            CleaningResult.content_hash.in_(content_hashes),
+            CleaningResult.ai_suggestion["status"].astext.is_distinct_from("error")
+        )
+        .distinct(CleaningResult.content_hash)
+        .order_by(CleaningResult.content_hash, CleaningResult.id.desc())
+    )
+
+def _candidate_hashes(scored_docs: List[Tuple[str, float]]) -> List[str]:
+    """
+    Content hashes of all neighbours within the similarity threshold, most similar first.
+    
+    The row's own embedding is usually saved before the lookup and ranks first,
+    so stopping at the nearest neighbour would only ever match identical rows.
+    """
+    return list(dict.fromkeys(
+        hash_content(content) for content, similarity in scored_docs
+        if similarity >= SEMANTIC_CACHE_THRESHOLD
+    ))
+
+def _best_suggestion(content_hashes: List[str], rows) -> Optional[Dict[str, Any]]:
+    """Suggestion of the most similar neighbour that has one"""
+    suggestions = dict(rows)
+    for content_hash in content_hashes:
+        if content_hash in suggestions:
+            return suggestions[content_hash]
+    return None
+
+def _record(suggestion: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Count the lookup as a hit or miss"""
+    SEMANTIC_CACHE_LOOKUPS.labels(result="hit" if suggestion is not None else "miss").inc()
+    if suggestion is not None:
+        logger.info("Semantic cache hit, skipping LLM call")
+    return suggestion
+
+def find_cached_suggestion(tenant_id: str, scored_docs: List[Tuple[str, float]]) -> Optional[Dict[str, Any]]:
+    """
+    Stored suggestion of a near-duplicate row, or None on a miss.
+    
+    Args:
+        tenant_id: Tenant identifier
+        scored_docs: (content, similarity) of the row's nearest tenant embeddings, best first
+    """
+    content_hashes = _candidate_hashes(scored_docs)
+    if not content_hashes:
+        return _record(None)
+    
+    session = get_session()
+    try:
+        rows = session.execute(_cached_suggestions_statement(tenant_id, content_hashes)).all()
+        return _record(_best_suggestion(content_hashes, rows))
+    except Exception as e:
+        logger.warning(f"Semantic cache lookup failed: {e}")
+        return _record(None)
+    finally:
+        session.close()
+
+async def find_cached_suggestion_async(
+    session: AsyncSession,
+    tenant_id: str,
+    scored_docs: List[Tuple[str, float]]
+) -> Optional[Dict[str, Any]]:
+    """Async variant of find_cached_suggestion running on the caller's session"""
+    content_hashes = _candidate_hashes(scored_docs)
+    if not content_hashes:
+        return _record(None)
+    
+    try:
+        rows = (await session.execute(_cached_suggestions_statement(tenant_id, content_hashes))).all()
+        return _record(_best_suggestion(content_hashes, rows))
+    except Exception as e:
+        logger.warning(f"Semantic cache lookup failed: {e}")
+        await session.rollback()
+        return _record(None)
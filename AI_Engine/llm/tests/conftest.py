@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The engine modules import each other as top-level modules (run from AI_Engine/llm)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,75 @@
+import orjson
+from llm import JsonObjectScanner, _batch_suggestions, _chunk_by_size, find_json_object
+
+
+def test_find_json_object_in_prose():
+    assert find_json_object('Here you go: {"field": "x"} Hope it helps.') == '{"field": "x"}'
+
+
+def test_find_json_object_skips_non_json_braces():
+    assert find_json_object('Use {placeholder} syntax. {"field": "x"}') == '{"field": "x"}'
+
+
+def test_find_json_object_finds_object_inside_non_json_braces():
+    assert find_json_object('{note: {"field": "x"} }') == '{"field": "x"}'
+
+
+def test_find_json_object_ignores_braces_in_strings():
+    text = 'x {"a": "}{\\"", "b": {"c": 1}} y'
+    assert orjson.loads(find_json_object(text)) == {"a": '}{"', "b": {"c": 1}}
+
+
+def test_find_json_object_without_object():
+    assert find_json_object("no braces here") is None
+    assert find_json_object("{not json}") is None
+    assert find_json_object('{"unclosed": 1') is None
+
+
+def test_scanner_across_chunks():
+    scanner = JsonObjectScanner()
+    chunks = ['Use {pl', 'ace} then {"a"', ': [1, {"b": 2}]', '} tail']
+    assert [scanner.feed(chunk) for chunk in chunks] == [None, None, None, '{"a": [1, {"b": 2}]}']
+
+
+def test_chunk_by_size_keeps_order_and_limit():
+    requests = [b"x" * 100] * 10
+    chunks = _chunk_by_size(requests, 400)
+    assert [request for chunk in chunks for request in chunk] == requests
+    assert all(64 + sum(len(request) + 64 for request in chunk) <= 400 for chunk in chunks)
+    assert len(chunks) == 5
+
+
+def test_chunk_by_size_oversized_request_gets_own_chunk():
+    chunks = _chunk_by_size([b"a", b"b" * 1000, b"c"], 200)
+    assert chunks == [[b"a"], [b"b" * 1000], [b"c"]]
+
+
+def test_chunk_by_size_single_chunk():
+    assert _chunk_by_size([b"a", b"b"], 10_000) == [[b"a", b"b"]]
+
+
+def _response(text):
+    return {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+
+
+def test_batch_suggestions_placed_by_key():
+    batch = {
+        "name": "batches/1",
+        "response": {"inlinedResponses": {"inlinedResponses": [
+            {"metadata": {"key": "1"}, "response": _response("second")},
+            {"metadata": {"key": "0"}, "response": _response("first")},
+        ]}}
+    }
+    assert _batch_suggestions(batch, 2) == ["first", "second"]
+
+
+def test_batch_suggestions_errors_and_missing():
+    batch = {
+        "name": "batches/1",
+        "response": {"inlinedResponses": [
+            {"metadata": {"key": "0"}, "error": {"message": "quota"}},
+        ]}
+    }
+    failed, missing = [orjson.loads(text) for text in _batch_suggestions(batch, 2)]
+    assert failed["status"] == "error" and failed["message"] == "LLM batch request failed"
+    assert missing["status"] == "error" and missing["message"] == "LLM batch response missing"
@@ -0,0 +1,23 @@
+import numpy as np
+from rag import _top_k_indices
+
+
+def test_top_k_indices_best_first():
+    similarities = np.array([0.1, 0.9, 0.5, 0.7, 0.3], dtype=np.float32)
+    assert _top_k_indices(similarities, 3).tolist() == [1, 3, 2]
+
+
+def test_top_k_indices_k_at_least_n():
+    similarities = np.array([0.2, 0.8, 0.5], dtype=np.float32)
+    assert _top_k_indices(similarities, 3).tolist() == [1, 2, 0]
+    assert _top_k_indices(similarities, 10).tolist() == [1, 2, 0]
+
+
+def test_top_k_indices_empty():
+    assert _top_k_indices(np.array([0.5], dtype=np.float32), 0).tolist() == []
+    assert _top_k_indices(np.empty(0, dtype=np.float32), 3).tolist() == []
+
+
+def test_top_k_indices_matches_full_sort():
+    similarities = np.random.default_rng(0).random(1000, dtype=np.float32)
+    assert _top_k_indices(similarities, 10).tolist() == np.argsort(similarities)[::-1][:10].tolist()
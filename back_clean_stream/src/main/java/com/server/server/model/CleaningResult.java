@@ -31,13 +31,13 @@ public class CleaningResult {
     private UUID datasetId;
 
     /**
-     * Stored as JSON in PostgreSQL
+     * Stored as JSONB in PostgreSQL
      * Keep as String unless you want JsonNode mapping
      */
-    @Column(name = "row_data", columnDefinition = "json", nullable = false)
+    @Column(name = "row_data", columnDefinition = "jsonb", nullable = false)
     private String rowData;
 
-    @Column(name = "ai_suggestion", columnDefinition = "json", nullable = false)
+    @Column(name = "ai_suggestion", columnDefinition = "jsonb", nullable = false)
     private String aiSuggestion;
 
     @Column